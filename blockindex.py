@@ -0,0 +1,175 @@
+# Copyright nycz 2011-2013
+
+# This file is part of Kalpana.
+
+# Kalpana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Kalpana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, chain, islice
+
+from PyQt4 import QtCore
+
+
+class BlockIndex(QtCore.QObject):
+    """
+    Per-block data about a document, kept up to date by only looking at
+    the blocks that are touched by each edit.
+    """
+    wordcount_changed = QtCore.pyqtSignal(int)
+
+    def __init__(self, document, snapshot):
+        super().__init__()
+        self.document = document
+        self.snapshot = snapshot
+        self.wordcounts = array('L')
+        self.total_words = 0
+        # prefix_sums[n] is the number of words before block n. It's only
+        # brought up to date when needed, see get_prefix_sums
+        self.prefix_sums = array('L', [0])
+        # Set by whoever wants to know where the headings are, see
+        # set_heading_matcher
+        self.heading_matcher = None
+        self.heading_blocks = []
+        self.heading_names = []
+        self.revision = document.revision()
+        self.rebuild()
+        document.contentsChange.connect(self.contents_changed)
+
+    def rebuild(self):
+        """ Recount everything. Only needed if the index gets out of sync. """
+        texts = self.block_texts(0, self.document.blockCount()-1)
+        self.wordcounts = array('L', [count_words(t) for t in texts])
+        self.total_words = sum(self.wordcounts)
+        self.prefix_sums = array('L', [0])
+        self.heading_blocks, self.heading_names = \
+                find_headings(self.heading_matcher, texts, 0)
+        self.wordcount_changed.emit(self.total_words)
+
+    def set_heading_matcher(self, matcher):
+        """
+        Set the function that finds headings and search the whole document
+        with it. The function gets the text of a block and should return
+        the heading's name, or None if the block isn't a heading.
+        """
+        self.heading_matcher = matcher
+        self.heading_blocks, self.heading_names = \
+                find_headings(matcher, self.block_texts(0, self.document.blockCount()-1), 0)
+
+    def contents_changed(self, position, chars_removed, chars_added):
+        """
+        Update the blocks affected by an edit.
+
+        The blocks between position and position+chars_added are the new
+        versions of the changed blocks. How many old blocks they replace can
+        be deduced from how much the block count has changed.
+        """
+        doc = self.document
+        # The spell check's rehighlighting emits contentsChange without
+        # changing any text, which shouldn't cost any recounting
+        if chars_removed == chars_added and doc.revision() == self.revision:
+            return
+        self.revision = doc.revision()
+        first = doc.findBlock(position)
+        if not first.isValid():
+            first = doc.lastBlock()
+        last = doc.findBlock(position + chars_added)
+        if not last.isValid():
+            last = doc.lastBlock()
+        first_num, last_num = first.blockNumber(), last.blockNumber()
+        new_size = last_num - first_num + 1
+        old_size = new_size - (doc.blockCount() - len(self.wordcounts))
+        if old_size < 1 or first_num + old_size > len(self.wordcounts):
+            self.rebuild()
+            return
+        texts = self.block_texts(first_num, last_num)
+        new_counts = array('L', [count_words(t) for t in texts])
+        old_total = self.total_words
+        self.total_words += sum(new_counts) \
+                - sum(self.wordcounts[first_num:first_num+old_size])
+        self.wordcounts[first_num:first_num+old_size] = new_counts
+        # Everything after the first changed block is out of date
+        del self.prefix_sums[first_num+1:]
+        if self.heading_matcher is not None:
+            self.update_headings(first_num, old_size, texts)
+        if self.total_words != old_total:
+            self.wordcount_changed.emit(self.total_words)
+
+    def get_prefix_sums(self):
+        """
+        Return an array where item n is the number of words before block n,
+        and the last item is the total number of words.
+        """
+        extend_prefix_sums(self.prefix_sums, self.wordcounts)
+        return self.prefix_sums
+
+    def update_headings(self, first, old_size, texts):
+        """
+        Replace the headings in the old_size blocks starting at first with
+        the ones in texts, and move the headings after them accordingly.
+        """
+        low = bisect_left(self.heading_blocks, first)
+        high = bisect_left(self.heading_blocks, first + old_size)
+        delta = len(texts) - old_size
+        if delta:
+            self.heading_blocks[high:] = [n + delta for n in self.heading_blocks[high:]]
+        blocks, names = find_headings(self.heading_matcher, texts, first)
+        self.heading_blocks[low:high] = blocks
+        self.heading_names[low:high] = names
+
+    def block_texts(self, first, last):
+        """ Return the text of every block from first to last (inclusive). """
+        doc = self.document
+        if first == 0 and last == doc.blockCount()-1:
+            # Faster than walking through every block in python, but only
+            # usable if there are no stray line separators in the blocks
+            lines = self.snapshot.lines()
+            if len(lines) == last + 1:
+                return lines
+        texts = []
+        block = doc.findBlockByNumber(first)
+        for _ in range(last - first + 1):
+            texts.append(block.text())
+            block = block.next()
+        return texts
+
+
+def count_words(text):
+    """ Return the number of whitespace-separated words in text. """
+    return len(text.split())
+
+def extend_prefix_sums(prefix_sums, counts):
+    """
+    Extend prefix_sums (which always starts with 0) with the running totals
+    of the items in counts it doesn't cover yet.
+    """
+    done = len(prefix_sums) - 1
+    if done < len(counts):
+        prefix_sums.extend(islice(accumulate(chain([prefix_sums[-1]],
+                                                   counts[done:])), 1, None))
+
+def find_headings(matcher, texts, first):
+    """
+    Return a list of the block numbers of the headings in texts (where
+    the first text is block number first), and a list of their names.
+    """
+    blocks, names = [], []
+    if matcher is None:
+        return blocks, names
+    for n, text in enumerate(texts, first):
+        name = matcher(text)
+        if name is not None:
+            blocks.append(n)
+            names.append(name)
+    return blocks, names
@@ -1,4 +1,4 @@
-from operator import itemgetter
+from bisect import bisect_right
 import re
 
 from PyQt4 import QtCore, QtGui
@@ -8,15 +8,25 @@ from common import Configable
 class ChapterError(Exception):
     pass
 
-class ChapterSidebar(QtGui.QListWidget, Configable):
+class ChapterSidebar(QtGui.QListView, Configable):
     goto_line = QtCore.pyqtSignal(int)
     error = QtCore.pyqtSignal(str)
 
-    def __init__(self, settingsmanager, get_text, get_text_cursor):
+    def __init__(self, settingsmanager, get_text_cursor, block_index):
         super().__init__()
         self.init_settings_functions(settingsmanager)
-        self.get_text = get_text
         self.get_text_cursor = get_text_cursor
+        self.block_index = block_index
+        self.settings_error = 'no settings'
+        self.register_setting('chapter strings', self.set_chapter_strings)
+        self.chapter_model = ChapterListModel()
+        self.setModel(self.chapter_model)
+        # All items are two lines, so there's no need to measure every one
+        self.setUniformItemSizes(True)
+        # The width of every current item's text in bold, to avoid measuring
+        # all of them again every time the list is updated
+        self.width_cache = {}
+        self.update_fonts()
         self.setDisabled(True)
         self.error_reasons = {
             'no chapters': 'No chapters detected!',
@@ -37,28 +47,87 @@ class ChapterSidebar(QtGui.QListWidget, Configable):
             else:
                 self.error.emit(self.error_reasons[self.current_error])
 
-    def update_list(self):
-        self.clear()
-        prologuename = self.get_setting('prologue chapter name')
-        chapter_strings = self.get_setting('chapter strings')
+    def set_chapter_strings(self, chapter_strings):
+        """
+        Make the block index look for the new chapter headings.
+        Broken settings aren't reported until the chapters are needed.
+        """
+        matcher = None
         if not chapter_strings:
-            self.current_error = 'no settings'
-            return
-        try:
-            validate_chapter_strings(chapter_strings)
-        except AssertionError:
-            self.current_error = 'broken settings'
+            self.settings_error = 'no settings'
+        else:
+            try:
+                validate_chapter_strings(chapter_strings)
+            except AssertionError:
+                self.settings_error = 'broken settings'
+            else:
+                self.settings_error = None
+                matcher = make_heading_matcher(chapter_strings)
+        self.block_index.set_heading_matcher(matcher)
+
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        if event.type() == QtCore.QEvent.FontChange:
+            self.update_fonts()
+
+    def update_fonts(self):
+        bold_font = QtGui.QFont(self.font())
+        bold_font.setBold(True)
+        self.chapter_model.set_bold_font(bold_font)
+        self.width_cache = {}
+
+    def get_text_width(self, items):
+        """ Return the width of the widest item in bold. """
+        font_metrics = None
+        # Only the current items are kept, so the cache doesn't grow
+        # every time a word count changes
+        width_cache = {}
+        for item in items:
+            if item in self.width_cache:
+                width_cache[item] = self.width_cache[item]
+            elif item not in width_cache:
+                if font_metrics is None:
+                    font_metrics = QtGui.QFontMetrics(self.chapter_model.bold_font)
+                width_cache[item] = max(font_metrics.width(line)
+                                        for line in item.split('\n'))
+        self.width_cache = width_cache
+        return max(width_cache.values(), default=0)
+
+    def get_extra_width(self):
+        """
+        Return the width needed around the item text: the item's padding
+        (which the stylesheet can change), the frame and the scrollbar,
+        which shows up when there are a lot of chapters.
+        """
+        padding = 0
+        if self.chapter_model.items:
+            # Measure the padding on the first item, it's the same for all
+            index = self.chapter_model.index(0)
+            font = self.chapter_model.data(index, QtCore.Qt.FontRole) or self.font()
+            font_metrics = QtGui.QFontMetrics(font)
+            text_width = max(font_metrics.width(line)
+                             for line in self.chapter_model.items[0].split('\n'))
+            padding = max(0, self.sizeHintForIndex(index).width() - text_width)
+        scrollbar_width = self.verticalScrollBar().sizeHint().width()
+        # A few extra pixels to not end up right at the edge
+        return padding + 2*self.frameWidth() + scrollbar_width + 4
+
+    def update_list(self):
+        if self.settings_error:
+            self.chapter_model.set_items([])
+            self.current_error = self.settings_error
             return
-        lines = self.get_text().splitlines()
+        prologuename = self.get_setting('prologue chapter name')
+        index = self.block_index
         try:
-            self.linenumbers, items = get_chapters_data(lines, prologuename, chapter_strings)
+            self.linenumbers, items = get_chapters_data(index.heading_blocks,
+                    index.heading_names, index.get_prefix_sums(), prologuename)
         except ChapterError as e:
+            self.chapter_model.set_items([])
             self.current_error = str(e)
         else:
-            self.addItems(items)
-            self.mod_items_fonts(bold=True)
-            self.setFixedWidth(self.sizeHintForColumn(0)+5)
-            self.mod_items_fonts(bold=False)
+            self.chapter_model.set_items(items)
+            self.setFixedWidth(self.get_text_width(items) + self.get_extra_width())
             self.update_active_chapter(self.get_text_cursor().blockNumber(), force=True)
             self.current_error = None
 
@@ -67,65 +136,154 @@ class ChapterSidebar(QtGui.QListWidget, Configable):
         Update the list to make the chapter the cursor is in bold.
         Triggered by moving the cursor (a signal from textarea.py).
         """
-        if not force and (not self.count() or not self.isVisible()):
+        model = self.chapter_model
+        if not force and (not model.rowCount() or not self.isVisible()):
             return
-        pos = blocknumber+1
-        self.mod_items_fonts(bold=False)
-        for n, ch in list(enumerate(self.linenumbers))[::-1]:
-            if pos >= ch:
-                i = self.item(n)
-                i.setFont(mod_font(i, True))
-                break
+        chapter = get_active_chapter(blocknumber, self.linenumbers)
+        if chapter != model.active or force:
+            model.set_active(chapter)
 
     def goto_line_or_chapter(self, arg):
         """ Scroll to the specified line or chapter. """
         if arg.isdigit():
             self.goto_line.emit(int(arg))
         elif re.match(r'c-?\d+', arg):
-            self.update_list()
-            if self.current_error:
-                self.error.emit(self.error_reasons[self.current_error])
+            # No need to update the whole list just to find one chapter
+            error = self.get_index_error()
+            if error:
+                self.error.emit(self.error_reasons[error])
                 return
+            heading_blocks = self.block_index.heading_blocks
             chapter = int(arg[1:].strip('-'))
-            if chapter in range(1, len(self.linenumbers)):
+            if chapter in range(1, len(heading_blocks)+1):
                 if arg[1] == '-':
-                    chapter = -chapter
-                self.goto_line.emit(self.linenumbers[chapter])
+                    chapter = len(heading_blocks) + 1 - chapter
+                self.goto_line.emit(heading_blocks[chapter-1] + 1)
             else:
                 self.error.emit('Invalid chapter number')
         else:
             self.error.emit('Invalid line or chapter number')
 
+    def get_index_error(self):
+        """ Return what's wrong with the chapters in the block index, if anything. """
+        if self.settings_error:
+            return self.settings_error
+        if BROKEN_HEADING in self.block_index.heading_names:
+            return 'broken settings'
+        if not self.block_index.heading_blocks:
+            return 'no chapters'
+        return None
+
     def get_chapter_text(self, chapter):
-        self.update_list()
-        if self.current_error:
-            self.error.emit(self.error_reasons[self.current_error])
+        """
+        Return the text of the chapter, reading only its blocks from
+        the document.
+        """
+        error = self.get_index_error()
+        if error:
+            self.error.emit(self.error_reasons[error])
             return
-        lines = self.get_text().splitlines()
+        index = self.block_index
         try:
-            text = get_chapter_text(chapter, lines, self.linenumbers)
+            text = get_chapter_text(chapter, index.heading_blocks,
+                                    index.document.blockCount(), index.block_texts)
         except ChapterError as e:
             self.error.emit(str(e))
         else:
             return text
 
-    def mod_items_fonts(self, bold):
-        for item_nr in range(self.count()):
-            i = self.item(item_nr)
-            i.setFont(mod_font(i, bold))
 
+class ChapterListModel(QtCore.QAbstractListModel):
+    """
+    The items in the chapter sidebar. New items are diffed against the old
+    ones so only the rows that actually changed are updated in the view.
+    """
+    def __init__(self):
+        super().__init__()
+        self.items = []
+        self.active = None
+        self.bold_font = None
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.items):
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            return self.items[index.row()]
+        if role == QtCore.Qt.FontRole and index.row() == self.active:
+            return self.bold_font
+        return None
+
+    def set_bold_font(self, font):
+        self.bold_font = font
+        self.set_active(self.active)
 
-def mod_font(item, bold):
-    font = item.font()
-    font.setBold(bold)
-    return font
+    def set_active(self, row):
+        """ Make row the active (bold) row. """
+        old_row, self.active = self.active, row
+        for n in {old_row, row}:
+            if n is not None and n < len(self.items):
+                self.dataChanged.emit(self.index(n), self.index(n))
 
-def get_chapter_text(chapter, lines, linenumbers):
-    """ Return the text inside the specified chapter. """
-    if chapter not in range(len(linenumbers)):
+    def set_items(self, items):
+        start, old_end, new_end = diff_items(self.items, items)
+        changed_end = min(old_end, new_end)
+        if changed_end > start:
+            self.items[start:changed_end] = items[start:changed_end]
+            self.dataChanged.emit(self.index(start), self.index(changed_end-1))
+        if old_end > new_end:
+            self.beginRemoveRows(QtCore.QModelIndex(), changed_end, old_end-1)
+            del self.items[changed_end:old_end]
+            self.endRemoveRows()
+        elif new_end > old_end:
+            self.beginInsertRows(QtCore.QModelIndex(), changed_end, new_end-1)
+            self.items[changed_end:changed_end] = items[changed_end:new_end]
+            self.endInsertRows()
+
+
+def diff_items(old, new):
+    """
+    Return (start, old_end, new_end), where old[start:old_end] is the part
+    of old that has to be replaced by new[start:new_end] to turn it into new.
+    Everything before start and after the ends is the same in both.
+    """
+    start = 0
+    shortest = min(len(old), len(new))
+    while start < shortest and old[start] == new[start]:
+        start += 1
+    old_end, new_end = len(old), len(new)
+    while old_end > start and new_end > start and old[old_end-1] == new[new_end-1]:
+        old_end -= 1
+        new_end -= 1
+    return start, old_end, new_end
+
+def get_active_chapter(blocknumber, linenumbers):
+    """
+    Return the number of the chapter that the block is in, or None if
+    there are no chapters.
+
+    linenumbers - the sorted line numbers where each chapter begins
+    """
+    chapter = bisect_right(linenumbers, blocknumber+1) - 1
+    return chapter if chapter >= 0 else None
+
+def get_chapter_text(chapter, heading_blocks, block_count, get_block_texts):
+    """
+    Return the text inside the specified chapter.
+
+    heading_blocks - the (sorted) block numbers of the chapter headings
+    block_count - the number of blocks in the document
+    get_block_texts - a function returning the texts of the blocks
+                      between two block numbers (inclusive)
+    """
+    if chapter not in range(len(heading_blocks)+1):
         raise ChapterError('Invalid chapter number')
-    ln = linenumbers + [len(lines)+1]
-    text = '\n'.join(lines[ln[chapter]:ln[chapter+1]-1]).strip('\n\t ')
+    first = heading_blocks[chapter-1] + 1 if chapter else 0
+    last = heading_blocks[chapter] - 1 if chapter < len(heading_blocks) else block_count - 1
+    lines = get_block_texts(first, last) if first <= last else []
+    text = '\n'.join(lines).strip('\n\t ')
     if not text:
         raise ChapterError('Chapter is only whitespace, ignoring')
     else:
@@ -150,42 +308,90 @@ def validate_chapter_strings(chapter_strings):
         except KeyError:
             raise AssertionError()
 
-def get_chapters_data(lines, prologuename, chapter_strings):
+# Marks a heading where not all groups in the regex are matched
+BROKEN_HEADING = object()
+
+def make_heading_matcher(chapter_strings):
+    """
+    Return a function that returns the name of the chapter if a line is a
+    chapter heading, BROKEN_HEADING if it matches a regex but not all
+    groups in that regex are matched, and None otherwise.
+
+    Lines matching more than one regex get the name from the last one,
+    but are broken if any of the matching regexes leaves a group unmatched.
+    """
+    patterns = [(re.compile(rx_str), template)
+                for rx_str, template in chapter_strings]
+    combined_rx = combine_heading_patterns(patterns)
+    def match_heading(line):
+        # Almost no lines are headings, so weed out the rest with
+        # one regex before trying every regex on its own
+        if combined_rx is not None and not combined_rx.match(line):
+            return None
+        name = None
+        for rx, template in patterns:
+            match = rx.match(line)
+            if match:
+                matchdict = match.groupdict()
+                # This happens if not all groups in the regex are matched
+                if None in matchdict.values():
+                    return BROKEN_HEADING
+                name = template.format(**matchdict).strip()
+        return name
+    return match_heading
+
+def combine_heading_patterns(patterns):
+    """
+    Return one regex matching the same lines as all the (compiled) regexes
+    in patterns, or None if they can't be combined.
+
+    The named groups in the regexes are renamed to _hN_name (where N is
+    the regex's index in patterns) to not collide with each other.
+    """
+    alternatives = []
+    for n, (rx, _) in enumerate(patterns):
+        rx_str = rx.pattern
+        # Backreferences and global flags can't be moved into a group
+        if re.search(r'\\\d|\(\?P=|\(\?[aiLmsux]+\)', rx_str):
+            return None
+        for name in rx.groupindex:
+            rx_str = rx_str.replace('(?P<{}>'.format(name),
+                                    '(?P<_h{}_{}>'.format(n, name))
+        alternatives.append('(?:{})'.format(rx_str))
+    try:
+        return re.compile('|'.join(alternatives))
+    except re.error:
+        return None
+
+def get_chapters_data(heading_blocks, heading_names, prefix_sums, prologuename):
     """
     Return two lists:
         linenumbers - the numbers of the lines where each chapter begins
         items - string with name and wordcount to add to the sidebar widget.
+
+    heading_blocks - the (sorted) block numbers of the chapter headings
+    heading_names - the names of the chapters
+    prefix_sums - the number of words before every block in the document,
+                  plus the total number of words at the end
     """
-    if not lines:
-        raise ChapterError('no chapters')
-    # Find lines that match the regexes
-    # Match to every rawstring possible, but overwrite earlier if needed
-    out = {}
-    for rx_str, template in chapter_strings: # all combinations
-        rx = re.compile(rx_str)
-        for n, line in enumerate(lines, 1): # all lines
-            if rx.match(line):
-                matchdict = rx.match(line).groupdict()
-                # This happens if not all groups in the regex are matched
-                if None in matchdict.values():
-                    raise ChapterError('broken settings')
-                out[n] = template.format(**matchdict).strip()
-    if not out:
+    if BROKEN_HEADING in heading_names:
+        raise ChapterError('broken settings')
+    if not heading_blocks:
         raise ChapterError('no chapters')
-    out[0] = prologuename
-    linenumbers, chapterlist = zip(*sorted(out.items(), key=itemgetter(0)))
-    chapter_lengths = get_chapter_wordcounts(linenumbers, lines)
+    linenumbers = [0] + [n+1 for n in heading_blocks]
+    chapterlist = [prologuename] + heading_names
+    chapter_lengths = get_chapter_wordcounts(heading_blocks, prefix_sums)
     items = ['{}\n   {}'.format(x,y)
              for x,y in zip(chapterlist, chapter_lengths)]
-    return list(linenumbers), items
+    return linenumbers, items
 
-def get_chapter_wordcounts(real_chapter_lines, lines):
+def get_chapter_wordcounts(heading_blocks, prefix_sums):
     """
-    Return a list of the word count for each chapter.
+    Return a list of the word count for each chapter, including the
+    prologue before the first heading. The headings themselves aren't counted.
 
-    real_chapter_lines - a list of line numbers where a chapter starts,
-                         including the prologue that starts on line 0.
+    prefix_sums - see get_chapters_data
     """
-    chapter_lines = list(real_chapter_lines) + [len(lines)+1]
-    return [len(re.findall(r'\S+', '\n'.join(lines[chapter_lines[i]:chapter_lines[i+1]-1])))
-            for i in range(len(chapter_lines)-1)]
+    starts = [0] + [n+1 for n in heading_blocks]
+    ends = list(heading_blocks) + [len(prefix_sums)-1]
+    return [prefix_sums[end] - prefix_sums[start] for start, end in zip(starts, ends)]
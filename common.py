@@ -1,9 +1,49 @@
+import os
+import os.path
+import tempfile
+
+
 class Configable():
     def init_settings_functions(self, settingsmanager):
         self.get_setting = settingsmanager.get_setting
         self.get_path = settingsmanager.get_path
-        self.register_setting = lambda settingname, callback: \
-                        settingsmanager.register_setting(settingname, callback)
+        self.register_setting = settingsmanager.register_setting
 
 class SettingsError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+def write_file_atomically(path, data):
+    """
+    Write data (bytes) to path without ever leaving a half-written file.
+
+    The data is written and synced to a temporary file in the same directory,
+    which then replaces the real file.
+    """
+    path = os.path.realpath(path)
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.'+name+'.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp only gives the owner access to the file
+        if os.path.exists(path):
+            mode = os.stat(path).st_mode
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    # Make sure the rename itself is on the disk (not possible on Windows)
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
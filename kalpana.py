@@ -29,6 +29,7 @@ from chaptersidebar import ChapterSidebar
 from mainwindow import MainWindow
 from pluginmanager import PluginManager
 from settingsmanager import SettingsManager
+from startuptrace import trace
 from terminal import Terminal
 from textarea import TextArea
 
@@ -41,32 +42,43 @@ class Kalpana(QtGui.QApplication):
 
     def __init__(self, configdir, file_to_open=None):
         super().__init__(['kalpana'])
-        self.objects = create_objects(configdir)
-        self.objects['mainwindow'].create_ui(self.objects['chaptersidebar'],
-                                             self.objects['textarea'],
-                                             self.objects['terminal'])
+        with trace.phase('create objects'):
+            self.objects = create_objects(configdir)
+        with trace.phase('create ui'):
+            self.objects['mainwindow'].create_ui(self.objects['chaptersidebar'],
+                                                 self.objects['textarea'],
+                                                 self.objects['terminal'])
         # Plugins
-        self.pluginmanager = PluginManager(self.objects.copy())
-        self.objects['terminal'].update_commands(self.pluginmanager.plugin_commands)
+        with trace.phase('plugins'):
+            self.pluginmanager = PluginManager(self.objects.copy())
+            self.objects['terminal'].update_commands(self.pluginmanager.plugin_commands)
         # Signals
-        connect_others_signals(*self.objects.values())
-        self.connect_own_signals()
+        with trace.phase('connect signals'):
+            connect_others_signals(*self.objects.values())
+            self.connect_own_signals()
         # Hotkeys
-        set_key_shortcuts(self.objects['mainwindow'], self.objects['textarea'],
-                          self.objects['terminal'],
-                          self.pluginmanager.get_compiled_hotkeys())
-        self.init_hotkeys()
+        with trace.phase('hotkeys'):
+            set_key_shortcuts(self.objects['mainwindow'], self.objects['textarea'],
+                              self.objects['terminal'],
+                              self.pluginmanager.get_compiled_hotkeys())
+            self.init_hotkeys()
         # Load settings and get it oooon
-        self.objects['settingsmanager'].load_settings()
+        with trace.phase('load settings'):
+            self.objects['settingsmanager'].load_settings()
         self.install_event_filter()
         # Try to open a file and die if it doesn't work, or make a new file
-        if file_to_open:
-            if not self.objects['textarea'].open_file(file_to_open):
-                self.close()
-        else:
-            self.objects['textarea'].set_filename(new=True)
+        with trace.phase('open file'):
+            if file_to_open:
+                if not self.objects['textarea'].open_file(file_to_open):
+                    self.close()
+            else:
+                self.objects['textarea'].set_filename(new=True)
         # FIN
-        self.objects['mainwindow'].show()
+        with trace.phase('show window'):
+            self.objects['mainwindow'].show()
+        report = trace.finish()
+        if report:
+            self.objects['terminal'].print_(report)
 
     def install_event_filter(self):
         # Event filter
@@ -77,18 +89,22 @@ class Kalpana(QtGui.QApplication):
                     self.activation_event.emit()
                 return False
         self.event_filter = AppEventFilter()
-        def refresh_config():
-            self.objects['settingsmanager'].load_settings(refresh_only=True)
-        self.event_filter.activation_event.connect(refresh_config)
+        self.event_filter.activation_event.connect(
+                self.objects['settingsmanager'].refresh_settings)
         self.installEventFilter(self.event_filter)
 
     def connect_own_signals(self):
         self.objects['settingsmanager'].set_stylesheet.connect(self.setStyleSheet)
+        self.aboutToQuit.connect(self.objects['settingsmanager'].finish_saving)
         self.objects['terminal'].list_plugins.connect(self.list_plugins)
 
     def list_plugins(self, _):
         plugins = self.pluginmanager.plugins
-        self.objects['terminal'].print_(', '.join(name for name, p in plugins))
+        deferred = self.pluginmanager.deferred_plugins
+        text = 'Loaded: ' + (', '.join(name for name, p in plugins) or '-')
+        if deferred:
+            text += '; not loaded yet: ' + ', '.join(deferred)
+        self.objects['terminal'].print_(text)
 
     # === Configurable hotkeys =========================================
 
@@ -118,7 +134,7 @@ def create_objects(configdir):
     smgr = SettingsManager(configdir)
     mw = MainWindow(smgr)
     txta = TextArea(mw, smgr)
-    chsb = ChapterSidebar(smgr, txta.toPlainText, txta.textCursor)
+    chsb = ChapterSidebar(smgr, txta.textCursor, txta.block_index)
     term = Terminal(mw, smgr, lambda: txta.file_path)
     # Ugly shit
     mw.set_is_modified_callback(txta.document().isModified)
@@ -181,6 +197,17 @@ def connect_others_signals(chaptersidebar, mainwindow, settingsmanager, terminal
         signal.connect(slot)
 
 
+def get_profile_env():
+    """
+    Return the startup profiling setting from the environment as a tuple
+    (enabled, json path). The variable can be 0/empty (off), 1 (on) or
+    the path to the json file.
+    """
+    value = os.environ.get('KALPANA_PROFILE_STARTUP', '')
+    if value in ('', '0'):
+        return False, None
+    return True, (None if value == '1' else value)
+
 def main():
     import argparse
     import os
@@ -198,9 +225,18 @@ def main():
         parser.error('Directory does not exist: {}'.format(dirname))
 
     parser.add_argument('-c', '--config-directory', type=valid_dir)
+    profile_enabled, profile_json = get_profile_env()
+    parser.add_argument('--profile-startup', action='store_true',
+                        default=profile_enabled,
+                        help='show the slowest parts of the startup in the terminal')
+    parser.add_argument('--profile-json', metavar='JSON_FILE', default=profile_json,
+                        help='profile the startup and save all of it as json')
     parser.add_argument('files', nargs='*', type=valid_file)
     args = parser.parse_args()
 
+    if args.profile_startup or args.profile_json:
+        trace.start(json_path=args.profile_json)
+
     if not args.files:
         app = Kalpana(args.config_directory)
     else:
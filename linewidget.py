@@ -22,7 +22,7 @@
 # Or more precisely: http://www.japh.de/blog/qtextedit-with-line-numbers/
 
 
-from PyQt4 import QtGui
+from PyQt4 import QtCore, QtGui
 
 
 class LineTextWidget(QtGui.QPlainTextEdit):
@@ -31,81 +31,94 @@ class LineTextWidget(QtGui.QPlainTextEdit):
         self.appendPlainText(string)
 
     class NumberBar(QtGui.QWidget):
+        """
+        The line numbers to the left of the text.
+
+        Only repainted when the text edit asks for it (see updateRequest),
+        and only the parts that actually changed. The font metrics are
+        cached and only measured again when the font changes.
+        """
 
         def __init__(self, parent):
             super().__init__(parent)
             self.edit = None
-            # This is used to update the width of the control.
-            # It is the highest line that is currently visibile.
-            self.highest_line = 0
             self.showbar = False
+            self.current_block = -1
+            self.number_font = None
+            self.bold_font = None
+            self.digit_width = 0
+            self.line_height = 0
 
         def set_text_edit(self, edit):
             self.edit = edit
-
-        def update(self, *args):
+            self.update_metrics()
+
+        def update_metrics(self):
+            """ Measure the font again. Only needed when the font changes. """
+            self.number_font = QtGui.QFont(self.edit.document().defaultFont())
+            self.bold_font = QtGui.QFont(self.number_font)
+            self.bold_font.setBold(True)
+            font_metrics = QtGui.QFontMetrics(self.bold_font)
+            self.digit_width = max(font_metrics.width(str(n)) for n in range(10))
+            self.line_height = font_metrics.height()
+            self.update_width()
+            self.update()
+
+        def update_width(self, *args):
             if not self.showbar:
                 width = 0
             else:
-                width = QtGui.QFontMetrics(self.edit.document().defaultFont()).\
-                                            width(str(self.highest_line)) + 10
+                digits = len(str(self.edit.blockCount()))
+                width = self.digit_width * digits + 10
             if self.width() != width:
                 self.setFixedWidth(width)
                 self.edit.setViewportMargins(width,0,0,0)
-            super().update(*args)
 
-        def paintEvent(self, event):
-            contents_y = 0
-            page_bottom = self.edit.viewport().height()
-            font_metrics = QtGui.QFontMetrics(self.edit.document().
-                                              defaultFont())
-            current_block = self.edit.document().findBlock(self.edit.
-                                                           textCursor().
-                                                           position())
+        def update_area(self, rect, dy):
+            """ Repaint or scroll the part of the bar next to rect. """
+            if not self.showbar:
+                return
+            if dy:
+                self.scroll(0, dy)
+            else:
+                self.update(0, rect.y(), self.width(), rect.height())
 
-            painter = QtGui.QPainter(self)
+        def cursor_moved(self):
+            # Only the bold line number has to be updated
+            block = self.edit.textCursor().blockNumber()
+            if block != self.current_block:
+                self.current_block = block
+                self.update()
 
-            # Iterate over all text blocks in the document.
-            block = self.edit.firstVisibleBlock()
-            viewport_offset = self.edit.contentOffset()
-            line_count = block.blockNumber()
-            painter.setFont(self.edit.document().defaultFont())
+        def paintEvent(self, event):
+            painter = QtGui.QPainter(self)
+            painter.setFont(self.number_font)
             painter.setPen(QtGui.QColor('darkGray'))
-            while block.isValid():
-                line_count += 1
-
-                # The top left position of the block in the document
-                position = self.edit.blockBoundingGeometry(block).topLeft()\
-                            + viewport_offset
-                # Check if the position of the block is out side of the visible
-                # area.
-                if position.y() > page_bottom:
-                    break
-
-                # We want the line number for the selected line to be bold.
-                bold = False
-                if block == current_block:
-                    bold = True
-                    font = painter.font()
-                    font.setBold(True)
-                    painter.setFont(font)
-
-                # Draw the line number right justified at the y position of the
-                # line. 3 is a magic padding number. drawText(x, y, text).
-                painter.drawText(self.width() - font_metrics.
-                                 width(str(line_count)) - 3,
-                                 round(position.y() + font_metrics.
-                                       ascent()*1.05), str(line_count))
-
-                # Remove the bold style if it was set previously.
-                if bold:
-                    font = painter.font()
-                    font.setBold(False)
-                    painter.setFont(font)
+            current_block = self.edit.textCursor().blockNumber()
+            self.current_block = current_block
+            dirty_top = event.rect().top()
+            dirty_bottom = event.rect().bottom()
 
+            block = self.edit.firstVisibleBlock()
+            top = self.edit.blockBoundingGeometry(block)\
+                    .translated(self.edit.contentOffset()).top()
+            while block.isValid() and top <= dirty_bottom:
+                height = self.edit.blockBoundingRect(block).height()
+                if block.isVisible() and top + height >= dirty_top:
+                    # 3 is a magic padding number
+                    rect = QtCore.QRectF(0, top, self.width() - 3, self.line_height)
+                    # We want the line number for the selected line to be bold.
+                    if block.blockNumber() == current_block:
+                        painter.setFont(self.bold_font)
+                        painter.drawText(rect, QtCore.Qt.AlignRight,
+                                         str(block.blockNumber() + 1))
+                        painter.setFont(self.number_font)
+                    else:
+                        painter.drawText(rect, QtCore.Qt.AlignRight,
+                                         str(block.blockNumber() + 1))
+                top += height
                 block = block.next()
 
-            self.highest_line = line_count
             painter.end()
 
             super().paintEvent(event)
@@ -117,11 +130,14 @@ class LineTextWidget(QtGui.QPlainTextEdit):
         self.number_bar = self.NumberBar(self)
         self.number_bar.set_text_edit(self)
 
-        self.viewport().installEventFilter(self)
+        self.updateRequest.connect(self.number_bar.update_area)
+        self.blockCountChanged.connect(self.number_bar.update_width)
+        self.cursorPositionChanged.connect(self.number_bar.cursor_moved)
 
     # ==== Setting callbacks ========================================
     def set_number_bar_visibility(self, visible):
         self.number_bar.showbar = visible
+        self.number_bar.update_width()
         self.number_bar.update()
     # ===============================================================
 
@@ -129,15 +145,12 @@ class LineTextWidget(QtGui.QPlainTextEdit):
         self.number_bar.setFixedHeight(self.height())
         super().resizeEvent(e)
 
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        # The document's font follows the widget's (eg. from the stylesheet)
+        if event.type() == QtCore.QEvent.FontChange:
+            self.number_bar.update_metrics()
+
     def setDefaultFont(self,font):
         self.document().setDefaultFont(font)
-
-    def eventFilter(self, object, event):
-        # Update the line numbers for all events on the text edit
-        # and the viewport.
-        # This is easier than connecting all necessary singals.
-        if object is self.viewport():
-            self.number_bar.update()
-            return False
-        # Not sure how this would work with super so i'm letting it be //nycz
-        return QtGui.QPlainTextEdit.eventFilter(object, event)
+        self.number_bar.update_metrics()
@@ -32,7 +32,7 @@ class MainWindow(QtGui.QFrame, Configable):
     def __init__(self, settingsmanager):
         super().__init__()
         self.init_settings_functions(settingsmanager)
-        self.register_setting('Show WordCount in titlebar', self.set_show_wordcount)
+        self.register_setting('Show WordCount in titlebar', self.set_show_wordcount, False)
 
         self.setAcceptDrops(True)
 
@@ -35,6 +35,10 @@ class GUIPlugin(QObject):
     def write_config(self):
         pass
 
+    def config_dirty(self):
+        """ Return True if write_config has anything to write. """
+        return True
+
     def print_(self, arg):
         self.signal_print.emit(arg)
 
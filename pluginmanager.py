@@ -15,60 +15,152 @@
 # You should have received a copy of the GNU General Public License
 # along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
+import functools
 import importlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
 import os
 from os.path import join, exists, dirname, isfile
 import sys
+import time
 
 from PyQt4 import QtCore
 
 from libsyntyche import common
+from startuptrace import trace
 
 class PluginManager(QtCore.QObject):
+    """
+    Load the plugins in loadorder.conf.
+
+    Plugins with a manifest.json declaring their commands and hotkeys
+    aren't imported until one of them is used. Until then they're
+    represented by stand-ins that load the plugin and pass the call on.
+    """
     def __init__(self, objects):
         super().__init__()
-        self.plugins, self.plugin_commands = init_plugins(objects)
+        self.objects = objects
+        self.plugins = []
+        self.deferred_plugins = OrderedDict()
+        self.plugin_commands = {}
+        self.plugin_hotkeys = {}
+        objects['plugins'] = self.plugins
+        paths = objects['settingsmanager'].paths
+        for name, path in get_plugin_paths(paths['plugins'], paths['loadorder']):
+            manifest = read_manifest(path)
+            if manifest is None:
+                with trace.phase('import ' + name):
+                    module = import_plugin(name, path)
+                if module is not None:
+                    with trace.phase('create ' + name):
+                        self.add_plugin(name, path, module)
+            else:
+                self.defer_plugin(name, path, manifest)
 
     def get_compiled_hotkeys(self):
-        hotkeys = {}
-        for name, p in self.plugins:
-            hotkeys.update(p.hotkeys)
-        return hotkeys
-
+        return self.plugin_hotkeys
 
-def init_plugins(objects):
-    """
-    Initiate all plugins and return the plugins and the commands they use.
-
-    objects - an ordered dict of all objects that the plugins can use.
-              Note that is has been copy()'d before passed to this function,
-              so no edits to it here will fuck anything else up.
-    """
-    plugins = []
-    plugin_commands = {}
-    objects['plugins'] = plugins
-    settingsmanager = objects['settingsmanager']
-    terminal = objects['terminal']
-    paths = settingsmanager.paths
-    for name, path, module in get_plugins(paths['plugins'], paths['loadorder']):
+    def add_plugin(self, name, path, module):
+        """ Create the plugin and connect it to everything. Return the plugin. """
         try:
             plugin_constructor = module.UserPlugin
         except AttributeError:
             print('"{0}" is not a valid plugin and was not loaded.'\
                   .format(name))
+            return None
+        p = plugin_constructor(self.objects, lambda:path)
+        self.plugins.append((name, p))
+        settingsmanager = self.objects['settingsmanager']
+        terminal = self.objects['terminal']
+        p.signal_print.connect(terminal.print_)
+        p.signal_error.connect(terminal.error)
+        p.signal_prompt.connect(terminal.prompt)
+        settingsmanager.read_plugin_config.connect(p.read_config)
+        settingsmanager.write_plugin_config.connect(
+                functools.partial(write_plugin_config, p))
+        if name not in self.deferred_plugins:
+            self.plugin_commands.update(p.commands)
+            self.plugin_hotkeys.update(p.hotkeys)
+        return p
+
+    def defer_plugin(self, name, path, manifest):
+        """ Add stand-ins for the commands and hotkeys in the manifest. """
+        self.deferred_plugins[name] = path
+        for command, info in manifest['commands'].items():
+            if isinstance(info, str):
+                info = [info]
+            callback = functools.partial(self.run_deferred_command, name, command)
+            self.plugin_commands[command] = (callback,) + tuple(info)
+        for hotkey in manifest['hotkeys']:
+            self.plugin_hotkeys[hotkey] = functools.partial(
+                    self.run_deferred_hotkey, name, hotkey)
+
+    def load_deferred_plugin(self, name):
+        """ Import and create a deferred plugin. Return None if it fails. """
+        if name not in self.deferred_plugins:
+            return dict(self.plugins).get(name)
+        path = self.deferred_plugins[name]
+        module = import_plugin(name, path)
+        p = None
+        if module is not None:
+            p = self.add_plugin(name, path, module)
+        del self.deferred_plugins[name]
+        if p is None:
+            self.objects['terminal'].error('Plugin {} could not be loaded'.format(name))
         else:
-            p = plugin_constructor(objects, lambda:path)
-            plugins.append((name, p))
-            p.signal_print.connect(terminal.print_)
-            p.signal_error.connect(terminal.error)
-            p.signal_prompt.connect(terminal.prompt)
-            settingsmanager.read_plugin_config.connect(p.read_config)
-            settingsmanager.write_plugin_config.connect(p.write_config)
-            plugin_commands.update(p.commands)
-    return plugins, plugin_commands
-
-
-def get_plugins(plugin_root_path, loadorder_path):
+            # The config has already been loaded for everyone else
+            p.read_config()
+        return p
+
+    def run_deferred_command(self, name, command, arg):
+        p = self.load_deferred_plugin(name)
+        if p is None:
+            return
+        if command not in p.commands:
+            self.objects['terminal'].error('Plugin {} has no command {}'.format(name, command))
+            return
+        p.commands[command][0](arg)
+
+    def run_deferred_hotkey(self, name, hotkey):
+        p = self.load_deferred_plugin(name)
+        if p is None:
+            return
+        if hotkey not in p.hotkeys:
+            self.objects['terminal'].error('Plugin {} has no hotkey {}'.format(name, hotkey))
+            return
+        p.hotkeys[hotkey]()
+
+
+def write_plugin_config(plugin):
+    """ Let the plugin write its config, if it has changed. """
+    if plugin.config_dirty():
+        plugin.write_config()
+
+
+def read_manifest(plugin_path):
+    """
+    Return the plugin's manifest with the keys commands (a dict with the
+    help text for each command) and hotkeys (a list), or None if there
+    is no valid manifest.
+    """
+    manifest_path = join(plugin_path, 'manifest.json')
+    if not isfile(manifest_path):
+        return None
+    try:
+        manifest = common.read_json(manifest_path)
+        commands = manifest.get('commands', {})
+        hotkeys = manifest.get('hotkeys', [])
+        assert isinstance(commands, dict) and isinstance(hotkeys, list)
+    except Exception:
+        print('Invalid manifest in {}, loading the plugin now.'.format(plugin_path))
+        return None
+    return {'commands': commands, 'hotkeys': hotkeys}
+
+
+def get_plugin_paths(plugin_root_path, loadorder_path):
+    """ Return the name and path of every plugin in the load order. """
     # Create the loadorder file if it doesn't exist
     if not os.path.exists(loadorder_path):
         open(loadorder_path, 'w').close()
@@ -80,13 +172,63 @@ def get_plugins(plugin_root_path, loadorder_path):
         if not os.path.exists(plugin_path):
             print("Plugin directory {} doesn't exist.".format(plugin_name))
             continue
-        sys.path.append(plugin_path)
-        try:
-            loaded_plugin = importlib.import_module(plugin_name)
-        except ImportError:
-            print("Plugin {} could not be imported. Most likely because it's "
-                  "not a valid plugin.".format(plugin_name))
-        else:
-            print("Plugin {} loaded.".format(plugin_name))
-            out.append((plugin_name, plugin_path, loaded_plugin))
+        out.append((plugin_name, plugin_path))
     return out
+
+
+class PluginFinder(importlib.abc.MetaPathFinder):
+    """
+    Find plugins in their directories without adding the directories
+    to sys.path.
+
+    Only the names of added plugins are resolved. A plugin's main module
+    is loaded as a package with the plugin's directory as its __path__,
+    so the modules next to it are imported through the plugin
+    (from . import utils) and never clash with other plugins' modules.
+    """
+    def __init__(self):
+        self.plugin_paths = {}
+
+    def add_plugin(self, name, path):
+        self.plugin_paths[name] = path
+
+    def find_spec(self, fullname, path, target=None):
+        # Submodules are found through the plugin package's __path__
+        if path is not None or fullname not in self.plugin_paths:
+            return None
+        plugin_path = self.plugin_paths[fullname]
+        module_path = join(plugin_path, fullname + '.py')
+        if not isfile(module_path):
+            # The plugin is a package of its own inside the directory
+            return importlib.machinery.PathFinder.find_spec(fullname, [plugin_path])
+        return importlib.util.spec_from_file_location(
+                fullname, module_path, submodule_search_locations=[plugin_path])
+
+
+plugin_finder = PluginFinder()
+
+
+def import_plugin(plugin_name, plugin_path):
+    """ Import the plugin's main module. Return None if it fails. """
+    # First, so plugins named like a Kalpana or stdlib module still load.
+    # The finder only answers for plugin names, so nothing else is shadowed.
+    if plugin_finder not in sys.meta_path:
+        sys.meta_path.insert(0, plugin_finder)
+    plugin_finder.add_plugin(plugin_name, plugin_path)
+    module = sys.modules.get(plugin_name)
+    module_file = getattr(module, '__file__', None) or ''
+    if module is not None and not module_file.startswith(join(plugin_path, '')):
+        print("Plugin {} has the same name as a module that's already "
+              "imported and can't be loaded.".format(plugin_name))
+        return None
+    start_time = time.perf_counter()
+    try:
+        loaded_plugin = importlib.import_module(plugin_name)
+    except ImportError:
+        print("Plugin {} could not be imported. Most likely because it's "
+              "not a valid plugin.".format(plugin_name))
+        return None
+    else:
+        print("Plugin {} loaded in {:.1f} ms.".format(plugin_name,
+              (time.perf_counter() - start_time) * 1000))
+        return loaded_plugin
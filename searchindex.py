@@ -0,0 +1,162 @@
+# Copyright nycz 2011-2013
+
+# This file is part of Kalpana.
+
+# Kalpana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Kalpana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left, bisect_right
+import functools
+import re
+
+
+class MatchIndex():
+    """
+    The sorted start and end positions of all matches of a search pattern
+    in a document. All positions are Qt positions.
+
+    Literal search terms can't match across lines, so an edit only
+    requires the touched blocks to be searched again. Regex matches can
+    depend on text anywhere in the document, so for those (and for really
+    big edits) the index is invalidated and has to be rebuilt.
+    """
+    max_rescan_blocks = 1000
+
+    def __init__(self, document, pattern, literal):
+        self.document = document
+        self.pattern = pattern
+        self.literal = literal
+        self.starts = []
+        self.ends = []
+        self.valid = False
+
+    def __len__(self):
+        return len(self.starts)
+
+    def build(self, text, astral_indexes):
+        """ Find all matches in text, which has to be the whole document. """
+        self.starts, self.ends = [], []
+        for match in self.pattern.finditer(text):
+            self.starts.append(to_qt_position(match.start(), astral_indexes))
+            self.ends.append(to_qt_position(match.end(), astral_indexes))
+        self.valid = True
+
+    def contents_changed(self, position, chars_removed, chars_added):
+        if not self.valid:
+            return
+        doc = self.document
+        first = doc.findBlock(position)
+        last = doc.findBlock(position + chars_added)
+        if not last.isValid():
+            last = doc.lastBlock()
+        block_span = last.blockNumber() - first.blockNumber()
+        if not self.literal or not first.isValid() \
+                or block_span > self.max_rescan_blocks:
+            self.valid = False
+            return
+        delta = chars_added - chars_removed
+        new_end = last.position() + last.length()
+        old_end = new_end - delta
+        low = bisect_left(self.starts, first.position())
+        high = bisect_left(self.starts, old_end)
+        new_starts, new_ends = [], []
+        block = first
+        for _ in range(block_span + 1):
+            text = block.text()
+            astrals = get_astral_indexes(text)
+            for match in self.pattern.finditer(text):
+                new_starts.append(block.position() + to_qt_position(match.start(), astrals))
+                new_ends.append(block.position() + to_qt_position(match.end(), astrals))
+            block = block.next()
+        self.starts[low:high] = new_starts
+        self.ends[low:high] = new_ends
+        if delta:
+            tail = low + len(new_starts)
+            self.starts[tail:] = [p + delta for p in self.starts[tail:]]
+            self.ends[tail:] = [p + delta for p in self.ends[tail:]]
+
+    def next_match(self, position):
+        """
+        Return the number of the first match starting at or after position,
+        wrapping around to the first match if there is none.
+        Return None if there are no matches at all.
+        """
+        if not self.starts:
+            return None
+        n = bisect_left(self.starts, position)
+        # Don't get stuck on an empty match
+        if n < len(self.starts) and self.starts[n] == self.ends[n] == position:
+            n += 1
+        return n if n < len(self.starts) else 0
+
+    def previous_match(self, position):
+        """
+        Return the number of the last match ending at or before position,
+        wrapping around to the last match if there is none.
+        Return None if there are no matches at all.
+        """
+        if not self.starts:
+            return None
+        n = bisect_right(self.ends, position) - 1
+        return n if n >= 0 else len(self.starts) - 1
+
+    def matches_between(self, start, end):
+        """ Return a range of the numbers of the matches overlapping start-end. """
+        return range(bisect_right(self.ends, start), bisect_left(self.starts, end))
+
+
+@functools.lru_cache(maxsize=32)
+def compile_search_pattern(term, case_sensitive=True, whole_words=False, regex=False):
+    """
+    Return a compiled regex for the search term.
+
+    Unless regex is True, the term is matched literally, the same way as
+    QTextDocument.find does with the corresponding flags.
+    The result is cached so repeated searches don't recompile the pattern.
+    """
+    pattern = term if regex else re.escape(term)
+    if whole_words:
+        # Qt only counts letters and numbers as parts of words
+        pattern = r'(?<![^\W_])(?:' + pattern + r')(?![^\W_])'
+    return re.compile(pattern, 0 if case_sensitive else re.IGNORECASE)
+
+def unescape_slashes(text):
+    """ Turn the escaped slashes in the search/replace syntax into slashes. """
+    return text.replace('\\/', '/')
+
+def get_astral_indexes(text):
+    """
+    Return a sorted list of the indexes of all characters outside the
+    basic multilingual plane.
+
+    Qt counts positions in UTF-16 code units, so these characters take up
+    two positions in the document but only one in a python string.
+    """
+    return [m.start() for m in re.finditer('[\U00010000-\U0010FFFF]', text)]
+
+def to_qt_position(index, astral_indexes):
+    """ Convert an index in a python string to a position in Qt. """
+    return index + bisect_left(astral_indexes, index)
+
+def from_qt_position(position, astral_indexes):
+    """ Convert a position in Qt to an index in a python string. """
+    # Count the astral characters before the position, keeping in mind
+    # that every one before them takes up an extra position in Qt.
+    low, high = 0, len(astral_indexes)
+    while low < high:
+        middle = (low + high) // 2
+        if astral_indexes[middle] + middle < position:
+            low = middle + 1
+        else:
+            high = middle
+    return position - low
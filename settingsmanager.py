@@ -16,16 +16,23 @@
 # along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
 
 from collections import defaultdict, ChainMap
+import hashlib
+import json
 import os
 from os.path import join, exists, dirname
 import re
 import shutil
+import threading
+import time
 
 from PyQt4 import QtGui
-from PyQt4.QtCore import pyqtSignal, QObject, Qt
+from PyQt4.QtCore import pyqtSignal, QObject, Qt, QTimer
 
 from libsyntyche import common
-from common import SettingsError
+from common import SettingsError, write_file_atomically
+
+# Marks a setting that hasn't been given any value yet
+UNSET = object()
 
 class SettingsManager(QObject):
     print_ = pyqtSignal(str)
@@ -34,6 +41,11 @@ class SettingsManager(QObject):
     read_plugin_config = pyqtSignal()
     write_plugin_config = pyqtSignal()
     set_stylesheet = pyqtSignal(str)
+    # The saved config, or an empty string if it couldn't be saved
+    config_saved = pyqtSignal(str)
+
+    # How long (in milliseconds) to wait for more changes before saving
+    save_delay = 500
 
     def __init__(self, configdir):
         super().__init__()
@@ -41,16 +53,33 @@ class SettingsManager(QObject):
         for x in ('config_dir', 'plugins', 'spellcheck-pwl'):
             if not exists(self.paths[x]):
                 os.makedirs(self.paths[x], mode=0o755, exist_ok=True)
-        self.current_style = {}
+        # A hash of the style and the template, see get_updated_css
+        self.style_key = None
+        self.applied_css = None
         self.css_template = common.read_file(common.local_path('template.css'))
 
         self.default_config = get_default_config()
         self.auto_setting_acronyms = get_auto_setting_acronym(self.default_config)
         self.setting_types = get_setting_types(self.default_config)
         self.setting_callbacks = defaultdict(list)
+        # The values the callbacks have been called with so far
+        self.applied_settings = {}
+        # The number of calls and total time spent in each callback
+        self.callback_timings = {}
 
         self.auto_settings, self.manual_settings = {}, {}
         self.settings = ChainMap()
+        # What the config files looked like the last time they were
+        # read or written, see get_file_signature
+        self.file_signatures = {}
+        self.save_timer = QTimer(self)
+        self.save_timer.setSingleShot(True)
+        self.save_timer.setInterval(self.save_delay)
+        self.save_timer.timeout.connect(self.write_settings)
+        self.last_saved_config = None
+        self.save_thread = None
+        self.saves_in_progress = 0
+        self.config_saved.connect(self.background_save_finished)
 
     # ======= Dict wrappers =============
     def get_setting(self, key):
@@ -66,17 +95,29 @@ class SettingsManager(QObject):
         return self.paths['config_dir']
     # ===================================
 
-    def register_setting(self, settingname, callback):
+    def register_setting(self, settingname, callback, initial_value=UNSET):
         """
         Save a callback function for a specified setting to be called when the
         setting is changed.
 
         settingname should be the full name (case-sensitive), not the acronym.
 
+        initial_value is what the setting already is before the callback has
+        been called, eg. a widget's default. The callbacks are only called
+        when the setting is different from that. If any callback for the
+        setting has no initial value (or a different one), they are all
+        called when the settings are loaded.
+
         Note that this doesn't check anything when called to make sure the
         setting actually exists.
         """
+        first_callback = settingname not in self.setting_callbacks
         self.setting_callbacks[settingname].append(callback)
+        applied_value = self.applied_settings.get(settingname, UNSET)
+        if first_callback and initial_value is not UNSET:
+            self.applied_settings[settingname] = initial_value
+        elif setting_changed(applied_value, initial_value):
+            self.applied_settings.pop(settingname, None)
 
     def set_setting(self, key, value):
         """
@@ -93,16 +134,47 @@ class SettingsManager(QObject):
         """ Load settings from the main config file. """
         self.settings, errormsg = \
             load_settings(self.paths, self.default_config, self.settings,
-                          self.setting_callbacks, self.setting_types, refresh_only)
+                          self.setting_callbacks, self.setting_types,
+                          self.applied_settings, self.callback_timings)
         self.auto_settings, self.manual_settings = self.settings.maps
+        self.update_signature('config_file')
+        # If nothing is changed, there's no need to write the same thing back
+        self.last_saved_config = read_saved_config(self.paths['config_file'])
         if errormsg:
             self.error.emit(errormsg)
         if self.settings['start in terminal'] and not refresh_only:
             self.switch_focus_to_terminal.emit()
-        self.save_settings()
+        if not refresh_only:
+            # Fill in any settings missing from the config file
+            self.save_settings()
         self.read_plugin_config.emit()
         self.set_theme()
 
+    def refresh_settings(self):
+        """
+        Reload the config or the style, but only if they have actually been
+        changed since they were last read or written.
+        """
+        # The file is about to be overwritten anyway
+        if self.save_timer.isActive() or self.saves_in_progress:
+            return
+        if self.update_signature('config_file'):
+            self.load_settings(refresh_only=True)
+        elif self.update_signature('style'):
+            self.set_theme()
+
+    def update_signature(self, path_name):
+        """
+        Remember what the file looks like now.
+        Return True if it has changed since the last time.
+        """
+        old_signature = self.file_signatures.get(path_name)
+        new_signature = get_file_signature(self.paths[path_name], old_signature)
+        self.file_signatures[path_name] = new_signature
+        if old_signature is None or new_signature is None:
+            return old_signature is not new_signature
+        return new_signature[2] != old_signature[2]
+
 
     def change_setting(self, arg):
         """
@@ -117,6 +189,9 @@ class SettingsManager(QObject):
         Print relevant error if value is not allowed, acronym does not exist,
         or the structure of argument does not follow above specification.
         """
+        if arg.strip() == '#':
+            self.print_.emit(format_callback_timings(self.callback_timings))
+            return
         # Print all settings
         if not arg.strip():
             self.print_.emit('Settings: {}'.format(', '.\
@@ -124,7 +199,8 @@ class SettingsManager(QObject):
             return
         try:
             setting, new_value = parse_setting_command(arg, self.auto_setting_acronyms,
-                                           self.setting_types, self.setting_callbacks)
+                                           self.setting_types, self.setting_callbacks,
+                                           self.applied_settings, self.callback_timings)
         except SettingsError as e:
             self.error.emit(str(e))
         else:
@@ -138,25 +214,92 @@ class SettingsManager(QObject):
                 self.print_.emit('{} now set to: {}'.format(setting.lower(), new_value))
 
     def save_settings(self):
-        """ Save the settings to the config file """
-        config_file_path = self.paths['config_file']
-        settings = {'automatic': self.auto_settings, 'manual': self.manual_settings}
-        common.write_json(config_file_path, settings)
+        """
+        Save the settings to the config file in a little while. Any other
+        changes made before then are saved at the same time.
+        """
+        self.save_timer.start()
+
+    def write_settings(self):
+        """
+        Write the settings to the config file in a background thread,
+        unless they're the same as the last time they were saved.
+        """
+        self.save_timer.stop()
+        # Every plugin checks for itself if its config needs to be written
         self.write_plugin_config.emit()
+        settings = {'automatic': self.auto_settings, 'manual': self.manual_settings}
+        data = json.dumps(settings, ensure_ascii=False, indent=2, sort_keys=True)
+        if data == self.last_saved_config:
+            return
+        self.saves_in_progress += 1
+        thread = threading.Thread(target=self.write_in_background,
+                                  args=(self.paths['config_file'], data,
+                                        self.save_thread))
+        self.save_thread = thread
+        thread.start()
+
+    def write_in_background(self, path, data, previous_thread):
+        # Keep the saves in order
+        if previous_thread is not None:
+            previous_thread.join()
+        try:
+            write_file_atomically(path, data.encode('utf-8'))
+        except OSError as e:
+            print('Could not save the config: {}'.format(e))
+            data = ''
+        self.config_saved.emit(data)
+
+    def background_save_finished(self, data):
+        self.saves_in_progress -= 1
+        # Failed saves are tried again the next time
+        if data:
+            self.last_saved_config = data
+        if not self.saves_in_progress:
+            # Don't reload our own changes
+            self.update_signature('config_file')
+
+    def finish_saving(self):
+        """ Write any unsaved settings and wait for them to be written. """
+        if self.save_timer.isActive():
+            self.write_settings()
+        if self.save_thread is not None:
+            self.save_thread.join()
 
     def set_theme(self):
-        result = get_updated_css(self.paths['style'],
-                                             self.current_style,
-                                             self.css_template)
+        result = get_updated_css(self.paths['style'], self.paths['style_cache'],
+                                 self.style_key, self.css_template)
         if result is not None:
-            new_style, new_css = result
-            # This actually sets the style, is catched in kalpana.py
-            self.set_stylesheet.emit(new_css)
-            self.current_style = new_style
+            self.style_key, new_css = result
+            # Restyling every widget is slow, so don't do it for nothing
+            if new_css != self.applied_css:
+                # This actually sets the style, is catched in kalpana.py
+                self.set_stylesheet.emit(new_css)
+                self.applied_css = new_css
+        self.update_signature('style')
 
 
 ## ==== Functions ========================================================= ##
 
+def get_file_signature(path, old_signature=None):
+    """
+    Return a tuple of the file's modification time, size and sha1 hash,
+    or None if it doesn't exist.
+
+    The file is only read and hashed if the time or size differ from
+    old_signature. Compare the hashes to see if the content has changed.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if old_signature is not None \
+            and old_signature[:2] == (stat.st_mtime_ns, stat.st_size):
+        return old_signature
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return (stat.st_mtime_ns, stat.st_size, digest)
+
 def get_default_config():
     return common.read_json(common.local_path('defaultconfig.json'))
 
@@ -210,6 +353,14 @@ def read_config(config_file_path, default_config):
                 for k,v in default_config[type_].items()}
     return generate_settings('automatic'), generate_settings('manual')
 
+def read_saved_config(config_file_path):
+    """ Return the contents of the config file, or None if it can't be read. """
+    try:
+        with open(config_file_path, encoding='utf-8') as f:
+            return f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+
 def valid_setting(setting, value, setting_types):
     """
     Return True if the setting matches the type that's been identified earlier
@@ -227,14 +378,44 @@ def valid_setting(setting, value, setting_types):
         return True
     return isinstance(value, type_)
 
-def update_runtime_setting(key, new_value, setting_callbacks):
-    """ Change specific runtime-settings. """
+def setting_changed(old_value, new_value):
+    """ Return True unless the values are equal and of the same type. """
+    return type(old_value) is not type(new_value) or old_value != new_value
+
+def update_runtime_setting(key, new_value, setting_callbacks,
+                           applied_settings, callback_timings):
+    """
+    Change specific runtime-settings, unless they are already set to new_value.
+
+    applied_settings - the values the callbacks have been called with so far
+    callback_timings - the number of calls and total time (in seconds)
+                       for each (setting, callback name) pair
+    """
+    if not setting_changed(applied_settings.get(key, UNSET), new_value):
+        return
     for callback in setting_callbacks.get(key, []):
+        start_time = time.perf_counter()
         callback(new_value)
-
-def load_settings(paths, default_config, oldsettings,
-                  setting_callbacks, setting_types, refresh_only):
-    """ Load settings from the main config file. """
+        name = getattr(callback, '__qualname__', repr(callback))
+        calls, total = callback_timings.get((key, name), (0, 0))
+        callback_timings[(key, name)] = (calls + 1, total + time.perf_counter() - start_time)
+    applied_settings[key] = new_value
+
+def format_callback_timings(callback_timings, count=10):
+    """ Return a summary of the slowest setting callbacks. """
+    if not callback_timings:
+        return 'No setting callbacks have been called'
+    slowest = sorted(callback_timings.items(), key=lambda x: x[1][1], reverse=True)
+    return 'Slowest setting callbacks: ' + ', '.join(
+        '{} ({}): {:.1f} ms/{} calls'.format(name, key.lower(), total*1000, calls)
+        for (key, name), (calls, total) in slowest[:count])
+
+def load_settings(paths, default_config, oldsettings, setting_callbacks,
+                  setting_types, applied_settings, callback_timings):
+    """
+    Load settings from the main config file.
+    Only the callbacks for settings that have changed are called.
+    """
     auto_settings, manual_settings\
              = read_config(paths['config_file'], default_config)
     settings = ChainMap(auto_settings, manual_settings)
@@ -250,8 +431,6 @@ def load_settings(paths, default_config, oldsettings,
     error = False
     # Make sure the settings aren't fucked up yo
     for key, value in settings.items():
-        if refresh_only and oldsettings.get(key) == value:
-            continue
         # First make a simple check to see if the value is the right type
         if not valid_setting(key, value, setting_types):
             print('Invalid type for setting: "{}"'.format(key))
@@ -259,7 +438,8 @@ def load_settings(paths, default_config, oldsettings,
             revert_setting(key)
         # Then do a live update and see if things blow up
         try:
-            update_runtime_setting(key, value, setting_callbacks)
+            update_runtime_setting(key, value, setting_callbacks,
+                                   applied_settings, callback_timings)
         except SettingsError as e:
             print(str(e))
             error = True
@@ -267,7 +447,8 @@ def load_settings(paths, default_config, oldsettings,
     error_text = 'Errors while reading the config. Check terminal output.'
     return settings, error_text if error else None
 
-def parse_setting_command(arg, auto_setting_acronyms, setting_types, setting_callbacks):
+def parse_setting_command(arg, auto_setting_acronyms, setting_types, setting_callbacks,
+                          applied_settings, callback_timings):
     """
     Return a pair of the identified setting and its new value.
     If no new value is specified, return the setting and None.
@@ -287,7 +468,8 @@ def parse_setting_command(arg, auto_setting_acronyms, setting_types, setting_cal
                                 .format(new_value, setting.lower()))
         else:
             try:
-                update_runtime_setting(setting, parsed_value, setting_callbacks)
+                update_runtime_setting(setting, parsed_value, setting_callbacks,
+                                       applied_settings, callback_timings)
             except SettingsError:
                 raise
             else:
@@ -323,33 +505,63 @@ def parse_terminal_setting(value, setting_type):
         return value
     return None
 
-def get_updated_css(stylepath, current_style, css_template):
+def get_updated_css(stylepath, cachepath, current_key, css_template):
     """
-    Return the style json and the complete css if it is valid and has been
-    changed since last update, otherwise return None.
+    Return the style's key and the complete css if it is valid and has been
+    changed since current_key was made, otherwise return None.
+
+    The key is a hash of both the style and the template. The css is read
+    from the cache file if it was made with the same key, otherwise it's
+    generated and written to the cache.
 
-    current_style - a dict with keys to format() the template
-    css_template - a format()-ready string that matches current_style
+    css_template - a format()-ready string that matches the style
     """
     # Copy in the default theme if a customized doesn't exist
     if not os.path.exists(stylepath):
         defaultcss = common.local_path('defaultstyle.json')
         shutil.copyfile(defaultcss, stylepath)
-    try:
-        style = common.read_json(stylepath)
-    except:
-        print('Invalid style config: unable to parse it as json')
-        return
+    with open(stylepath, 'rb') as f:
+        key = get_style_key(f.read(), css_template)
     # Only update if something's changed
-    if style != current_style:
+    if key == current_key:
+        return
+    css = read_cached_css(cachepath, key)
+    if css is None:
+        try:
+            style = common.read_json(stylepath)
+        except:
+            print('Invalid style config: unable to parse it as json')
+            return
         try:
             css = css_template.format(**style)
         except KeyError:
             print('Invalid style config: key missing')
             return
-        else:
-            return style, common.parse_stylesheet(css)
-    return
+        css = common.parse_stylesheet(css)
+        try:
+            write_file_atomically(cachepath, (style_cache_header(key) + css).encode('utf-8'))
+        except OSError as e:
+            print('Could not write the style cache: {}'.format(e))
+    return key, css
+
+def get_style_key(style_data, css_template):
+    """ Return a hash of the style (as bytes) and the css template. """
+    return hashlib.sha1(css_template.encode('utf-8') + b'\0' + style_data).hexdigest()
+
+def style_cache_header(key):
+    return '/* Generated by Kalpana from style.conf: {} */\n'.format(key)
+
+def read_cached_css(cachepath, key):
+    """ Return the cached css if it was made with key, otherwise None. """
+    try:
+        with open(cachepath, encoding='utf-8') as f:
+            cached = f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+    header = style_cache_header(key)
+    if not cached.startswith(header):
+        return None
+    return cached[len(header):]
 
 def get_paths(custom_config_dir):
     import platform
@@ -366,6 +578,7 @@ def get_paths(custom_config_dir):
         'config_dir':   config_dir,
         'config_file':  path('kalpana.conf'),
         'style':        path('style.conf'),
+        'style_cache':  path('stylecache.css'),
         'loadorder':    path('loadorder.conf'),
         'plugins':      path('plugins'),
         'spellcheck-pwl': path('spellcheck-pwl')
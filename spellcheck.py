@@ -0,0 +1,347 @@
+# Copyright nycz 2011-2013
+
+# This file is part of Kalpana.
+
+# Kalpana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Kalpana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
+
+from collections import defaultdict, OrderedDict
+import re
+import time
+
+from PyQt4 import QtCore, QtGui
+
+
+class Highlighter(QtGui.QSyntaxHighlighter):
+    """
+    Underline misspelled words.
+
+    Checking a whole document at once can take a long time, so whenever
+    a lot needs to be checked (spell check turned on, the language changed
+    or a big chunk of text inserted), only the visible blocks are checked
+    right away. The rest is
+    done in small batches from the event loop. Blocks that haven't been
+    reached by this background pass yet are left alone.
+
+    Attaching a highlighter to a document makes Qt rehighlight all of it,
+    so the highlighter should be attached while the document is empty and
+    stay attached. Spell check is turned on and off with set_active, and
+    while it's off Qt doesn't rehighlight anything when the text changes.
+    """
+    # Max time (in seconds) spent on every batch in the background pass
+    batch_time = 0.015
+    # How long (in milliseconds) the background pass waits after an edit
+    edit_pause = 300
+    # Edits touching more blocks than this are checked in the background
+    max_edit_blocks = 100
+
+    def __init__(self, parent, spellcache, get_visible_blocks):
+        super().__init__(parent)
+        self.dict = None
+        self.spellcache = spellcache
+        self.get_visible_blocks = get_visible_blocks
+        self.active = False
+        self.reformatting = True
+        self.block_count = 0
+        self.revision = 0
+        self.misspellings = MisspellingIndex()
+        # All blocks before pass_position have been checked in the current
+        # pass, as well as the ones in checked_ahead. None means no pass
+        # is in progress and every block should be checked.
+        self.pass_position = None
+        self.checked_ahead = set()
+        self.visible_checked = False
+        self.pass_timer = QtCore.QTimer(self)
+        self.pass_timer.setSingleShot(True)
+        self.pass_timer.timeout.connect(self.check_next_batch)
+
+    def setDocument(self, document):
+        self.stop_pass()
+        if self.document() is not None:
+            self.document().contentsChange.disconnect(self.contents_changed)
+        self.misspellings = MisspellingIndex()
+        if document is not None:
+            # This has to be connected before the superclass connects its own
+            # slot, to make sure the pass is updated before the edited
+            # blocks are highlighted.
+            document.contentsChange.connect(self.contents_changed)
+            self.block_count = document.blockCount()
+            self.revision = document.revision()
+        super().setDocument(document)
+        if document is None:
+            return
+        self.reformatting = True
+        # Qt schedules a rehighlight of the whole document when it's
+        # attached. Doing it right away uses that up while the document
+        # is (hopefully) still empty.
+        self.rehighlight()
+        if self.active:
+            self.start_pass()
+        else:
+            self.set_reformatting(False)
+
+    def set_active(self, active):
+        """ Turn spell check on or off without reattaching the highlighter. """
+        self.active = active
+        if active:
+            self.set_reformatting(True)
+            self.start_pass()
+            return
+        self.stop_pass()
+        doc = self.document()
+        if doc is None:
+            return
+        # Only the blocks with misspellings have anything to clear
+        for blocknumber in sorted(self.misspellings.words):
+            self.rehighlightBlock(doc.findBlockByNumber(blocknumber))
+        self.misspellings = MisspellingIndex()
+        self.set_reformatting(False)
+
+    def set_reformatting(self, on):
+        """
+        Connect or disconnect the superclass's slot that highlights the
+        edited blocks, so that edits cost nothing while spell check is off.
+        """
+        if self.document() is None or on == self.reformatting:
+            return
+        self.reformatting = on
+        args = (self.document(), QtCore.SIGNAL('contentsChange(int,int,int)'),
+                self, QtCore.SLOT('_q_reformatBlocks(int,int,int)'))
+        if on:
+            QtCore.QObject.connect(*args)
+        else:
+            QtCore.QObject.disconnect(*args)
+
+    def contents_changed(self, position, chars_removed, chars_added):
+        doc = self.document()
+        # rehighlightBlock emits contentsChange too, without changing
+        # any text, and that shouldn't postpone the background pass
+        if chars_removed == chars_added and doc.revision() == self.revision:
+            return
+        self.revision = doc.revision()
+        delta = doc.blockCount() - self.block_count
+        self.block_count = doc.blockCount()
+        if not self.active:
+            return
+        first = doc.findBlock(position).blockNumber()
+        last = doc.findBlock(position + chars_added).blockNumber()
+        if last < first:
+            last = self.block_count - 1
+        self.misspellings.shift_blocks(first, delta)
+        big_edit = last - first >= self.max_edit_blocks
+        if self.pass_position is None:
+            if not big_edit:
+                return
+            # Too much to check right away (eg. a file being loaded),
+            # so leave it to a background pass
+            self.pass_position = first
+            self.checked_ahead = set()
+            self.visible_checked = False
+        else:
+            if first < self.pass_position:
+                self.pass_position = max(first, self.pass_position + delta)
+            self.checked_ahead = shift_block_numbers(self.checked_ahead, first, delta)
+            if big_edit:
+                self.pass_position = min(first, self.pass_position)
+                self.visible_checked = False
+            else:
+                # The edited blocks are about to be rehighlighted
+                # and should be checked
+                self.checked_ahead.update(range(first, last+1))
+        # Let the user type in peace
+        self.pass_timer.start(self.edit_pause)
+
+    def start_pass(self):
+        """ Start checking the whole document in the background. """
+        if self.document() is None or not self.active:
+            return
+        self.pass_position = 0
+        self.checked_ahead = set()
+        self.visible_checked = False
+        self.pass_timer.start(0)
+
+    def stop_pass(self):
+        self.pass_timer.stop()
+        self.pass_position = None
+        self.checked_ahead = set()
+
+    def check_visible_blocks(self):
+        """ Check the unchecked blocks that are on the screen right now. """
+        if self.pass_position is None:
+            return
+        first, last = self.get_visible_blocks()
+        block = self.document().findBlockByNumber(max(first, self.pass_position))
+        while block.isValid() and block.blockNumber() <= last:
+            blocknumber = block.blockNumber()
+            if blocknumber not in self.checked_ahead:
+                self.checked_ahead.add(blocknumber)
+                self.rehighlightBlock(block)
+            block = block.next()
+
+    def check_next_batch(self):
+        if self.pass_position is None:
+            return
+        if not self.visible_checked:
+            self.visible_checked = True
+            self.check_visible_blocks()
+        deadline = time.perf_counter() + self.batch_time
+        block = self.document().findBlockByNumber(self.pass_position)
+        while block.isValid():
+            blocknumber = self.pass_position
+            self.pass_position += 1
+            if blocknumber in self.checked_ahead:
+                self.checked_ahead.discard(blocknumber)
+            else:
+                self.rehighlightBlock(block)
+            block = block.next()
+            if time.perf_counter() > deadline:
+                break
+        if block.isValid():
+            self.pass_timer.start(0)
+        else:
+            self.stop_pass()
+
+    def word_added(self, word):
+        """ Rehighlight only the blocks where word is marked as misspelled. """
+        doc = self.document()
+        if doc is None:
+            return
+        for blocknumber in self.misspellings.blocks_with(word):
+            self.rehighlightBlock(doc.findBlockByNumber(blocknumber))
+
+    def highlightBlock(self, text):
+        blocknumber = self.currentBlock().blockNumber()
+        if not self.active or not self.dict or (self.pass_position is not None
+                             and blocknumber >= self.pass_position
+                             and blocknumber not in self.checked_ahead):
+            self.misspellings.set_block(blocknumber, set())
+            return
+
+        format = QtGui.QTextCharFormat()
+        format.setUnderlineColor(QtCore.Qt.red)
+        format.setUnderlineStyle(QtGui.QTextCharFormat.SpellCheckUnderline)
+
+        misspelled = set()
+        for word in re.finditer(r'(?i)[\w\']+', text):
+            stripped_word = word.group().strip("'")
+            if not self.spellcache.check(self.dict, stripped_word):
+                self.setFormat(word.start(), word.end() - word.start(), format)
+                misspelled.add(stripped_word.lower())
+        self.misspellings.set_block(blocknumber, misspelled)
+
+
+class MisspellingIndex():
+    """
+    An inverted index of which blocks every misspelled word is in.
+    All words are stored in lower case.
+    """
+    def __init__(self):
+        self.blocks = defaultdict(set)
+        self.words = {}
+
+    def set_block(self, blocknumber, words):
+        """ Replace the misspelled words in the block with words. """
+        old_words = self.words.pop(blocknumber, set())
+        for word in old_words - words:
+            self.blocks[word].discard(blocknumber)
+            if not self.blocks[word]:
+                del self.blocks[word]
+        for word in words - old_words:
+            self.blocks[word].add(blocknumber)
+        if words:
+            self.words[blocknumber] = words
+
+    def shift_blocks(self, first, delta):
+        """
+        Adjust the index for delta blocks being added (or removed if
+        negative) right after the block first.
+        """
+        if not delta or not any(n > first for n in self.words):
+            return
+        self.words = {n + delta if n > first else n: words
+                      for n, words in self.words.items()
+                      if not first < n <= first - delta}
+        self.blocks = defaultdict(set)
+        for blocknumber, words in self.words.items():
+            for word in words:
+                self.blocks[word].add(blocknumber)
+
+    def blocks_with(self, word):
+        """ Return a sorted list of the blocks where word is misspelled. """
+        return sorted(self.blocks.get(word.lower(), ()))
+
+
+class SpellCache():
+    """
+    A bounded LRU cache in front of the enchant dictionaries' check().
+
+    The results are keyed by the dictionary's language tag, so switching
+    language doesn't throw away the cache for the other one.
+    """
+    default_size = 10000
+
+    def __init__(self, size=default_size):
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def check(self, dictionary, word):
+        """ Return True if word is spelled correctly according to dictionary. """
+        key = (dictionary.tag, word)
+        try:
+            correct = self.results[key]
+        except KeyError:
+            self.misses += 1
+            correct = dictionary.check(word)
+            if self.size > 0:
+                self.results[key] = correct
+                if len(self.results) > self.size:
+                    self.results.popitem(last=False)
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+        return correct
+
+    def resize(self, size):
+        self.size = size
+        while len(self.results) > size:
+            self.results.popitem(last=False)
+
+    def forget(self, tag, word):
+        """
+        Remove all cached results for word (in any capitalization) in the
+        dictionary with the specified tag.
+        """
+        word = word.lower()
+        for key in [k for k in self.results if k[0] == tag and k[1].lower() == word]:
+            del self.results[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hitrate = 100 * self.hits / lookups if lookups else 0
+        return 'Spell cache: {}/{} words, {} hits, {} misses ({:.1f}% hits)'\
+               ''.format(len(self.results), self.size, self.hits,
+                         self.misses, hitrate)
+
+
+def shift_block_numbers(blocknumbers, first, delta):
+    """
+    Return a new set of block numbers adjusted for delta blocks being added
+    (or removed if negative) right after the block first.
+    Removed blocks are dropped from the set.
+    """
+    if not delta:
+        return set(blocknumbers)
+    return {n + delta if n > first else n for n in blocknumbers
+            if not first < n <= first - delta}
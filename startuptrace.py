@@ -0,0 +1,119 @@
+# Copyright nycz 2011-2013
+
+# This file is part of Kalpana.
+
+# Kalpana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Kalpana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
+
+from contextlib import contextmanager
+import json
+import os.path
+import time
+import tracemalloc
+
+
+class StartupTrace():
+    """
+    Record the wall time and the memory allocated in each phase of the
+    startup. Does nothing unless start() has been called.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.json_path = None
+        self.phases = []
+        self.current = []
+        self.start_time = None
+        self.total_time = 0
+
+    def start(self, json_path=None):
+        """ Start tracing. The report is also written to json_path if specified. """
+        self.enabled = True
+        self.json_path = json_path
+        self.phases = []
+        self.start_time = time.perf_counter()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name):
+        """ Record everything done inside the with block as one phase. """
+        if not self.enabled:
+            yield
+            return
+        # Phases inside other phases are named after their parents too
+        self.current.append(name)
+        full_name = ' > '.join(self.current)
+        start_memory = tracemalloc.get_traced_memory()[0]
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            memory = tracemalloc.get_traced_memory()[0] - start_memory
+            self.phases.append((full_name, duration, memory))
+            self.current.pop()
+
+    def finish(self):
+        """
+        Stop tracing and write the json file if needed. Return a one-line
+        report of the slowest phases (for the terminal), or None if
+        nothing was traced.
+        """
+        if not self.enabled:
+            return None
+        self.enabled = False
+        self.total_time = time.perf_counter() - self.start_time
+        tracemalloc.stop()
+        summary = self.summary()
+        if self.json_path:
+            try:
+                # Never overwrite anything else, eg. a misplaced file name
+                if os.path.isfile(self.json_path) and os.path.getsize(self.json_path) \
+                        and not is_trace_file(self.json_path):
+                    raise OSError('the file exists and is not a startup trace')
+                with open(self.json_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.to_json(), f, indent=2)
+            except OSError as e:
+                summary += ' (could not write {}: {})'.format(self.json_path, e)
+            else:
+                summary += ' (saved in {})'.format(self.json_path)
+        return summary
+
+    def sorted_phases(self):
+        return sorted(self.phases, key=lambda x: x[1], reverse=True)
+
+    def summary(self, count=5):
+        """ Return the total time and the slowest phases on one line. """
+        phases = ', '.join('{} {:.0f} ms'.format(name, duration * 1000)
+                           for name, duration, _ in self.sorted_phases()[:count])
+        return 'Startup took {:.0f} ms. Slowest: {}'.format(self.total_time * 1000,
+                                                            phases or 'nothing')
+
+    def to_json(self):
+        return {'total seconds': self.total_time,
+                'phases': [{'name': name, 'seconds': duration, 'bytes': memory}
+                           for name, duration, memory in self.phases]}
+
+
+def is_trace_file(path):
+    """ Return True if the file at path is a json file written by a trace. """
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return isinstance(data, dict) and set(data) == {'total seconds', 'phases'}
+
+
+# There is only one startup to trace
+trace = StartupTrace()
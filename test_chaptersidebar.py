@@ -1,7 +1,24 @@
+import re
 import unittest
+from blockindex import count_words, extend_prefix_sums, find_headings
 from chaptersidebar import ChapterError, get_chapter_wordcounts,\
                            validate_chapter_strings, get_chapter_text,\
-                           get_chapters_data
+                           get_chapters_data, make_heading_matcher,\
+                           combine_heading_patterns, get_active_chapter,\
+                           diff_items,\
+                           BROKEN_HEADING
+
+def get_lines_data(lines, prologuename, chapter_strings):
+    """ Index the lines the same way the block index does and get the chapters. """
+    matcher = make_heading_matcher(chapter_strings)
+    heading_blocks, heading_names = find_headings(matcher, lines, 0)
+    return get_chapters_data(heading_blocks, heading_names,
+                             get_prefix_sums(lines), prologuename)
+
+def get_prefix_sums(lines):
+    prefix_sums = [0]
+    extend_prefix_sums(prefix_sums, [count_words(line) for line in lines])
+    return prefix_sums
 
 class GetChapterTextTest(unittest.TestCase):
 
@@ -18,31 +35,35 @@ Oh hey!
 
 >> CHAPTER 3
 >> CHAPTER 4""".splitlines()
-        self.linenumbers = [0, 2, 7, 10, 11]
+        self.heading_blocks = [1, 6, 9, 10]
+
+    def get_chapter_text(self, chapter):
+        return get_chapter_text(chapter, self.heading_blocks, len(self.lines),
+                                lambda first, last: self.lines[first:last+1])
 
     def test_normal_chapter(self):
-        result = get_chapter_text(1, self.lines, self.linenumbers)
+        result = self.get_chapter_text(1)
         self.assertEqual(result, 'Lorem ipsum.\nLine 2.\n\nOh hey!')
 
     def test_prologue(self):
-        result = get_chapter_text(0, self.lines, self.linenumbers)
+        result = self.get_chapter_text(0)
         self.assertEqual(result, 'fishies')
 
     def test_empty_string_chapter(self):
         with self.assertRaisesRegex(ChapterError, r'(?i)\bonly\s+whitespace\b'):
-            get_chapter_text(2, self.lines, self.linenumbers)
+            self.get_chapter_text(2)
 
     def test_empty_chapter(self):
         with self.assertRaisesRegex(ChapterError, r'(?i)\bonly\s+whitespace\b'):
-            get_chapter_text(3, self.lines, self.linenumbers)
+            self.get_chapter_text(3)
 
     def test_chapter_on_last_line(self):
         with self.assertRaisesRegex(ChapterError, r'(?i)\bonly\s+whitespace\b'):
-            get_chapter_text(4, self.lines, self.linenumbers)
+            self.get_chapter_text(4)
 
     def test_nonexistant_chapter(self):
         with self.assertRaisesRegex(ChapterError, r'(?i)\binvalid\s+chapter\s+number\b'):
-            get_chapter_text(5, self.lines, self.linenumbers)
+            self.get_chapter_text(5)
 
 
 
@@ -68,7 +89,7 @@ What will happen next!""".splitlines()
 
     def test_default_run(self):
         result_linenumbers, result_items = \
-            get_chapters_data(self.lines, self.prologuename, self.chapter_strings)
+            get_lines_data(self.lines, self.prologuename, self.chapter_strings)
         self.assertEqual(self.linenumbers, result_linenumbers)
         self.assertEqual(self.items, result_items)
 
@@ -82,7 +103,7 @@ Line 2.
 Exciting ending!
 What will happen next!""".splitlines()
         result_linenumbers, result_items = \
-            get_chapters_data(lines, self.prologuename, self.chapter_strings)
+            get_lines_data(lines, self.prologuename, self.chapter_strings)
         self.assertEqual(self.linenumbers, result_linenumbers)
         items = ['prologue\n   0', '1\n   4', '2 - Fish\n   6']
         self.assertEqual(items, result_items)
@@ -95,14 +116,14 @@ Line 2.
 
 >> CHAPTER 2""".splitlines()
         result_linenumbers, result_items = \
-            get_chapters_data(lines, self.prologuename, self.chapter_strings)
+            get_lines_data(lines, self.prologuename, self.chapter_strings)
         self.assertEqual(self.linenumbers, result_linenumbers)
         items = ['prologue\n   0', '1\n   4', '2\n   0']
         self.assertEqual(items, result_items)
 
     def test_no_lines(self):
         with self.assertRaises(ChapterError):
-            get_chapters_data([], self.prologuename, self.chapter_strings)
+            get_lines_data([], self.prologuename, self.chapter_strings)
 
     def test_no_matching_lines(self):
         lines = """\
@@ -114,14 +135,14 @@ Line 2.
 Exciting ending!
 What will happen next!""".splitlines()
         with self.assertRaises(ChapterError):
-            get_chapters_data(lines, self.prologuename, self.chapter_strings)
+            get_lines_data(lines, self.prologuename, self.chapter_strings)
 
     def test_invalid_chapter_regex(self):
         chapter_strings = [
             ['>> +CHAPTER (?P<num>\\d+)( ?[:-] (?P<name>.+))?', '{num} - {name}'],
         ]
         with self.assertRaisesRegex(ChapterError, 'broken settings'):
-            get_chapters_data(self.lines, self.prologuename, chapter_strings)
+            get_lines_data(self.lines, self.prologuename, chapter_strings)
 
 
 class GetChapterWordcountsTest(unittest.TestCase):
@@ -135,8 +156,8 @@ Line 2.
 >> CHAPTER 2
 Exciting ending!
 What will happen next!""".splitlines()
-        chapter_line_numbers = [0, 1, 5]
-        wordcounts = get_chapter_wordcounts(chapter_line_numbers, lines)
+        heading_blocks = [0, 4]
+        wordcounts = get_chapter_wordcounts(heading_blocks, get_prefix_sums(lines))
         self.assertEqual(wordcounts, [0, 4, 6])
 
     def test_default_run_with_prologue(self):
@@ -150,15 +171,14 @@ Line 2.
 >> CHAPTER 2
 Exciting ending!
 What will happen next!""".splitlines()
-        chapter_line_numbers = [0, 3, 7]
-        wordcounts = get_chapter_wordcounts(chapter_line_numbers, lines)
+        heading_blocks = [2, 6]
+        wordcounts = get_chapter_wordcounts(heading_blocks, get_prefix_sums(lines))
         self.assertEqual(wordcounts, [8, 4, 6])
 
-    def test_no_lines_at_all(self):
-        lines = []
-        chapter_line_numbers = []
-        wordcounts = get_chapter_wordcounts(chapter_line_numbers, lines)
-        self.assertEqual(wordcounts, [])
+    def test_empty_document(self):
+        # A document always has at least one (empty) block
+        wordcounts = get_chapter_wordcounts([], [0, 0])
+        self.assertEqual(wordcounts, [0])
 
     def test_no_chapters(self):
         lines = """\
@@ -166,8 +186,8 @@ Lorem ipsum dolor sit amet, consectetur adipisicing elit.
 Sed do eiusmod tempor.
 
 Incididunt ut labore et dolore magna aliqua.""".splitlines()
-        chapter_line_numbers = [0]
-        wordcounts = get_chapter_wordcounts(chapter_line_numbers, lines)
+        heading_blocks = []
+        wordcounts = get_chapter_wordcounts(heading_blocks, get_prefix_sums(lines))
         self.assertEqual(wordcounts, [19])
 
     def test_empty_chapters(self):
@@ -181,12 +201,125 @@ Incididunt ut labore et dolore magna aliqua.""".splitlines()
 
 
 """.splitlines()
-        chapter_line_numbers = [0, 2, 3, 6]
-        wordcounts = get_chapter_wordcounts(chapter_line_numbers, lines)
+        heading_blocks = [1, 2, 5]
+        wordcounts = get_chapter_wordcounts(heading_blocks, get_prefix_sums(lines))
         self.assertEqual(wordcounts, [0, 0, 0, 0])
 
 
 
+class GetActiveChapterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.linenumbers = [0, 2, 7, 10]
+
+    def test_prologue(self):
+        self.assertEqual(get_active_chapter(0, self.linenumbers), 0)
+
+    def test_on_heading(self):
+        self.assertEqual(get_active_chapter(6, self.linenumbers), 2)
+
+    def test_inside_chapter(self):
+        self.assertEqual(get_active_chapter(4, self.linenumbers), 1)
+
+    def test_last_chapter(self):
+        self.assertEqual(get_active_chapter(500, self.linenumbers), 3)
+
+    def test_no_chapters(self):
+        self.assertIsNone(get_active_chapter(3, []))
+
+
+class DiffItemsTest(unittest.TestCase):
+
+    def test_same(self):
+        self.assertEqual(diff_items(['a', 'b'], ['a', 'b']), (2, 2, 2))
+
+    def test_changed(self):
+        self.assertEqual(diff_items(['a', 'b', 'c'], ['a', 'x', 'c']), (1, 2, 2))
+
+    def test_inserted(self):
+        self.assertEqual(diff_items(['a', 'c'], ['a', 'b', 'b', 'c']), (1, 1, 3))
+
+    def test_removed(self):
+        self.assertEqual(diff_items(['a', 'b', 'c'], ['c']), (0, 2, 0))
+
+    def test_repeated_items(self):
+        self.assertEqual(diff_items(['a', 'a'], ['a', 'a', 'a']), (2, 2, 3))
+
+    def test_empty(self):
+        self.assertEqual(diff_items([], ['a']), (0, 0, 1))
+        self.assertEqual(diff_items(['a'], []), (0, 1, 0))
+
+
+class ExtendPrefixSumsTest(unittest.TestCase):
+
+    def test_extend(self):
+        prefix_sums = [0]
+        extend_prefix_sums(prefix_sums, [3, 0, 2])
+        self.assertEqual(prefix_sums, [0, 3, 3, 5])
+
+    def test_extend_partial(self):
+        prefix_sums = [0, 3]
+        extend_prefix_sums(prefix_sums, [3, 1, 2])
+        self.assertEqual(prefix_sums, [0, 3, 4, 6])
+
+    def test_already_done(self):
+        prefix_sums = [0, 3, 4]
+        extend_prefix_sums(prefix_sums, [3, 1])
+        self.assertEqual(prefix_sums, [0, 3, 4])
+
+
+class MakeHeadingMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chapter_strings = [
+            ['>> +CHAPTER (?P<num>\\d+)', 'Chapter {num}'],
+            ['>> +CHAPTER (?P<num>\\d+) ?[:-] (?P<name>.+)', '{num} - {name}'],
+        ]
+
+    def test_combined(self):
+        patterns = [(re.compile(rx), t) for rx, t in self.chapter_strings]
+        self.assertIsNotNone(combine_heading_patterns(patterns))
+
+    def test_later_pattern_overrides(self):
+        matcher = make_heading_matcher(self.chapter_strings)
+        self.assertEqual(matcher('>> CHAPTER 2 - Fish'), '2 - Fish')
+        self.assertEqual(matcher('>> CHAPTER 2'), 'Chapter 2')
+        self.assertIsNone(matcher('Lorem ipsum'))
+
+    def test_backreference_fallback(self):
+        chapter_strings = self.chapter_strings + [['(?P<x>=+) (?P<name>.+) (?P=x)$', '{name}']]
+        patterns = [(re.compile(rx), t) for rx, t in chapter_strings]
+        self.assertIsNone(combine_heading_patterns(patterns))
+        matcher = make_heading_matcher(chapter_strings)
+        self.assertEqual(matcher('== Fish =='), 'Fish')
+        self.assertEqual(matcher('>> CHAPTER 2 - Fish'), '2 - Fish')
+        self.assertIsNone(matcher('== Fish ='))
+
+    def test_broken_heading(self):
+        chapter_strings = [['>> +CHAPTER (?P<num>\\d+)( ?[:-] (?P<name>.+))?', '{num} - {name}']]
+        matcher = make_heading_matcher(chapter_strings)
+        self.assertIs(matcher('>> CHAPTER 2'), BROKEN_HEADING)
+        self.assertEqual(matcher('>> CHAPTER 2 - Fish'), '2 - Fish')
+
+    def test_broken_by_earlier_pattern(self):
+        # Like before the regexes were combined, a line is broken if any
+        # matching regex is, even if a later one matches all its groups
+        chapter_strings = [['>> +CHAPTER (?P<num>\\d+)(?P<name> - .+)?', '{num}{name}'],
+                           ['>> +CHAPTER (?P<num>\\d+)', 'Chapter {num}']]
+        matcher = make_heading_matcher(chapter_strings)
+        self.assertIs(matcher('>> CHAPTER 2'), BROKEN_HEADING)
+        self.assertEqual(matcher('>> CHAPTER 2 - Fish'), 'Chapter 2')
+
+    def test_same_as_fallback(self):
+        fallback_strings = self.chapter_strings + [['(?P<x>=+) (?P<name>.+) (?P=x)$', '{name}']]
+        matcher = make_heading_matcher(self.chapter_strings)
+        fallback_matcher = make_heading_matcher(fallback_strings)
+        lines = ['>> CHAPTER 2 - Fish', '>> CHAPTER 2', '>>  CHAPTER 12: Cat',
+                 '>> CHAPTER', 'Lorem ipsum', '', ' >> CHAPTER 3']
+        for line in lines:
+            self.assertEqual(matcher(line), fallback_matcher(line), line)
+
+
 class ValidateChapterStringsTest(unittest.TestCase):
 
     def test_valid_data(self):
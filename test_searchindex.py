@@ -0,0 +1,97 @@
+import unittest
+from searchindex import MatchIndex, compile_search_pattern, from_qt_position,\
+                        get_astral_indexes, to_qt_position, unescape_slashes
+
+
+class MatchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MatchIndex(None, compile_search_pattern('ab'), literal=True)
+        text = 'ab cd ab \U0001F600ab'
+        self.index.build(text, get_astral_indexes(text))
+
+    def test_build(self):
+        self.assertEqual(self.index.starts, [0, 6, 11])
+        self.assertEqual(self.index.ends, [2, 8, 13])
+        self.assertEqual(len(self.index), 3)
+
+    def test_next_match(self):
+        self.assertEqual(self.index.next_match(0), 0)
+        self.assertEqual(self.index.next_match(2), 1)
+        self.assertEqual(self.index.next_match(12), 0)
+
+    def test_previous_match(self):
+        self.assertEqual(self.index.previous_match(13), 2)
+        self.assertEqual(self.index.previous_match(7), 0)
+        self.assertEqual(self.index.previous_match(1), 2)
+
+    def test_matches_between(self):
+        self.assertEqual(list(self.index.matches_between(1, 7)), [0, 1])
+        self.assertEqual(list(self.index.matches_between(2, 6)), [])
+        self.assertEqual(list(self.index.matches_between(0, 100)), [0, 1, 2])
+
+    def test_no_matches(self):
+        index = MatchIndex(None, compile_search_pattern('x'), literal=True)
+        index.build('abc', [])
+        self.assertIsNone(index.next_match(0))
+        self.assertIsNone(index.previous_match(0))
+
+    def test_empty_match(self):
+        index = MatchIndex(None, compile_search_pattern('x*', regex=True), literal=False)
+        index.build('ab', [])
+        self.assertEqual(index.next_match(0), 1)
+
+
+class CompileSearchPatternTest(unittest.TestCase):
+
+    def setUp(self):
+        self.text = 'Fish, fishes and fish_sticks. (fish)'
+
+    def findall(self, term, **kwargs):
+        return [m.span() for m in compile_search_pattern(term, **kwargs).finditer(self.text)]
+
+    def test_literal(self):
+        self.assertEqual(self.findall('fish'), [(6, 10), (17, 21), (31, 35)])
+
+    def test_special_characters(self):
+        self.assertEqual(self.findall('(fish)'), [(30, 36)])
+
+    def test_case_insensitive(self):
+        self.assertEqual(len(self.findall('FISH', case_sensitive=False)), 4)
+
+    def test_whole_words(self):
+        # Underscores are not letters or numbers according to Qt
+        self.assertEqual(self.findall('fish', whole_words=True), [(17, 21), (31, 35)])
+
+    def test_regex(self):
+        self.assertEqual(self.findall(r'fish(es)?\b', regex=True), [(6, 12), (31, 35)])
+
+    def test_regex_whole_words(self):
+        self.assertEqual(self.findall('fish|and', regex=True, whole_words=True),
+                         [(13, 16), (17, 21), (31, 35)])
+
+
+class UnescapeSlashesTest(unittest.TestCase):
+
+    def test_unescape(self):
+        self.assertEqual(unescape_slashes(r'and\/or \1'), r'and/or \1')
+
+
+class QtPositionTest(unittest.TestCase):
+
+    def test_bmp_only(self):
+        astrals = get_astral_indexes('abc')
+        self.assertEqual(astrals, [])
+        self.assertEqual(to_qt_position(2, astrals), 2)
+
+    def test_astral_characters(self):
+        astrals = get_astral_indexes('a\U0001F41Fb\U0001F41Fc')
+        self.assertEqual(astrals, [1, 3])
+        self.assertEqual([to_qt_position(i, astrals) for i in range(6)],
+                         [0, 1, 3, 4, 6, 7])
+
+    def test_round_trip(self):
+        astrals = get_astral_indexes('a\U0001F41Fb\U0001F41Fc')
+        for i in range(6):
+            with self.subTest(i=i):
+                self.assertEqual(from_qt_position(to_qt_position(i, astrals), astrals), i)
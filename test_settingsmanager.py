@@ -2,8 +2,13 @@ import unittest
 import os
 import os.path
 import settingsmanager
+import tempfile
 from settingsmanager import parse_terminal_setting, valid_setting,\
-                            get_auto_setting_acronym, get_updated_css
+                            get_auto_setting_acronym, get_updated_css,\
+                            get_file_signature, read_cached_css,\
+                            style_cache_header, update_runtime_setting,\
+                            format_callback_timings
+from common import SettingsError
 
 
 class GetAutoSettingAcronymTest(unittest.TestCase):
@@ -129,7 +134,61 @@ class ValidSettingTest(unittest.TestCase):
 
 
 class UpdateRuntimeSettingTest(unittest.TestCase):
-    pass
+
+    def setUp(self):
+        self.calls = []
+        self.setting_callbacks = {'x': [self.calls.append]}
+        self.applied_settings = {}
+        self.callback_timings = {}
+
+    def update(self, value):
+        update_runtime_setting('x', value, self.setting_callbacks,
+                               self.applied_settings, self.callback_timings)
+
+    def test_changed(self):
+        self.update(1)
+        self.update(2)
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(self.applied_settings, {'x': 2})
+
+    def test_unchanged(self):
+        self.update(1)
+        self.update(1)
+        self.assertEqual(self.calls, [1])
+
+    def test_changed_type(self):
+        self.update(1)
+        self.update(True)
+        self.assertEqual(self.calls, [1, True])
+
+    def test_timings(self):
+        self.update(1)
+        self.update(2)
+        [(key, (calls, total))] = self.callback_timings.items()
+        self.assertEqual(key[0], 'x')
+        self.assertEqual(calls, 2)
+        self.assertGreaterEqual(total, 0)
+
+    def test_error(self):
+        def broken_callback(value):
+            raise SettingsError('broken')
+        self.setting_callbacks['x'].append(broken_callback)
+        with self.assertRaises(SettingsError):
+            self.update(1)
+        self.assertEqual(self.applied_settings, {})
+
+
+class FormatCallbackTimingsTest(unittest.TestCase):
+
+    def test_slowest_first(self):
+        timings = {('A', 'fast'): (1, 0.001), ('B', 'slow'): (2, 0.5)}
+        self.assertEqual(format_callback_timings(timings),
+                         'Slowest setting callbacks: slow (b): 500.0 ms/2 calls, '
+                         'fast (a): 1.0 ms/1 calls')
+
+    def test_empty(self):
+        self.assertEqual(format_callback_timings({}),
+                         'No setting callbacks have been called')
 
 
 class LoadSettingsTest(unittest.TestCase):
@@ -195,6 +254,60 @@ class ParseTerminalSettingTest(unittest.TestCase):
 #         get_updated_css(stylepath, )
 
 
+class ReadCachedCSSTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(style_cache_header('abc123') + 'QWidget {}')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_same_key(self):
+        self.assertEqual(read_cached_css(self.path, 'abc123'), 'QWidget {}')
+
+    def test_other_key(self):
+        self.assertIsNone(read_cached_css(self.path, 'def456'))
+
+    def test_missing_file(self):
+        self.assertIsNone(read_cached_css(self.path + '-missing', 'abc123'))
+
+
+class GetFileSignatureTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('{"a": 1}')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_unchanged(self):
+        signature = get_file_signature(self.path)
+        self.assertIs(get_file_signature(self.path, signature), signature)
+
+    def test_touched(self):
+        signature = get_file_signature(self.path)
+        os.utime(self.path, ns=(0, 0))
+        new_signature = get_file_signature(self.path, signature)
+        self.assertNotEqual(new_signature[0], signature[0])
+        self.assertEqual(new_signature[2], signature[2])
+
+    def test_changed(self):
+        signature = get_file_signature(self.path)
+        with open(self.path, 'w') as f:
+            f.write('{"a": 2}')
+        os.utime(self.path, ns=(0, 0))
+        self.assertNotEqual(get_file_signature(self.path, signature)[2], signature[2])
+
+    def test_missing_file(self):
+        os.remove(self.path)
+        self.assertIsNone(get_file_signature(self.path))
+
+
 class GetPathsTest(unittest.TestCase):
 
     def test_default_path(self):
@@ -203,6 +316,7 @@ class GetPathsTest(unittest.TestCase):
             'config_dir':   config_dir,
             'config_file':  os.path.join(config_dir, 'kalpana.conf'),
             'style':        os.path.join(config_dir, 'style.conf'),
+            'style_cache':  os.path.join(config_dir, 'stylecache.css'),
             'loadorder':    os.path.join(config_dir, 'loadorder.conf'),
             'plugins':      os.path.join(config_dir, 'plugins'),
             'spellcheck-pwl': os.path.join(config_dir, 'spellcheck-pwl')
@@ -215,6 +329,7 @@ class GetPathsTest(unittest.TestCase):
             'config_dir':   config_dir,
             'config_file':  os.path.join(config_dir, 'kalpana.conf'),
             'style':        os.path.join(config_dir, 'style.conf'),
+            'style_cache':  os.path.join(config_dir, 'stylecache.css'),
             'loadorder':    os.path.join(config_dir, 'loadorder.conf'),
             'plugins':      os.path.join(config_dir, 'plugins'),
             'spellcheck-pwl': os.path.join(config_dir, 'spellcheck-pwl')
@@ -228,6 +343,7 @@ class GetPathsTest(unittest.TestCase):
             'config_dir':   config_dir,
             'config_file':  os.path.join(config_dir, 'kalpana.conf'),
             'style':        os.path.join(config_dir, 'style.conf'),
+            'style_cache':  os.path.join(config_dir, 'stylecache.css'),
             'loadorder':    os.path.join(config_dir, 'loadorder.conf'),
             'plugins':      os.path.join(config_dir, 'plugins'),
             'spellcheck-pwl': os.path.join(config_dir, 'spellcheck-pwl')
@@ -0,0 +1,106 @@
+import unittest
+from spellcheck import MisspellingIndex, SpellCache, shift_block_numbers
+
+
+class FakeDict():
+    def __init__(self, tag, words):
+        self.tag = tag
+        self.words = words
+        self.lookups = 0
+
+    def check(self, word):
+        self.lookups += 1
+        return word in self.words
+
+
+class SpellCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dict = FakeDict('en_US', {'fish', 'cake'})
+
+    def test_cached_lookup(self):
+        cache = SpellCache(10)
+        self.assertTrue(cache.check(self.dict, 'fish'))
+        self.assertTrue(cache.check(self.dict, 'fish'))
+        self.assertFalse(cache.check(self.dict, 'fsih'))
+        self.assertEqual(self.dict.lookups, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_separate_languages(self):
+        cache = SpellCache(10)
+        other = FakeDict('sv_SE', {'fisk'})
+        self.assertTrue(cache.check(self.dict, 'fish'))
+        self.assertFalse(cache.check(other, 'fish'))
+
+    def test_least_recently_used_is_dropped(self):
+        cache = SpellCache(2)
+        for word in ('fish', 'cake', 'fish', 'tea'):
+            cache.check(self.dict, word)
+        self.assertEqual(list(cache.results), [('en_US', 'fish'), ('en_US', 'tea')])
+
+    def test_resize(self):
+        cache = SpellCache(10)
+        for word in ('fish', 'cake', 'tea'):
+            cache.check(self.dict, word)
+        cache.resize(1)
+        self.assertEqual(list(cache.results), [('en_US', 'tea')])
+
+    def test_disabled_cache(self):
+        cache = SpellCache(0)
+        cache.check(self.dict, 'fish')
+        cache.check(self.dict, 'fish')
+        self.assertEqual(self.dict.lookups, 2)
+        self.assertEqual(len(cache.results), 0)
+
+    def test_forget(self):
+        cache = SpellCache(10)
+        for word in ('Kalpana', 'kalpana', 'fish'):
+            cache.check(self.dict, word)
+        self.dict.words.update({'Kalpana', 'kalpana'})
+        cache.forget('en_US', 'kalpana')
+        self.assertTrue(cache.check(self.dict, 'Kalpana'))
+        self.assertEqual(list(cache.results), [('en_US', 'fish'), ('en_US', 'Kalpana')])
+
+
+class ShiftBlockNumbersTest(unittest.TestCase):
+
+    def test_no_change(self):
+        self.assertEqual(shift_block_numbers({1, 5, 9}, 4, 0), {1, 5, 9})
+
+    def test_added_blocks(self):
+        self.assertEqual(shift_block_numbers({1, 4, 5, 9}, 4, 2), {1, 4, 7, 11})
+
+    def test_removed_blocks(self):
+        self.assertEqual(shift_block_numbers({1, 4, 5, 6, 9}, 4, -2), {1, 4, 7})
+
+
+class MisspellingIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MisspellingIndex()
+        self.index.set_block(0, {'teh'})
+        self.index.set_block(3, {'teh', 'wrod'})
+        self.index.set_block(7, {'wrod'})
+
+    def test_blocks_with(self):
+        self.assertEqual(self.index.blocks_with('teh'), [0, 3])
+        self.assertEqual(self.index.blocks_with('Wrod'), [3, 7])
+        self.assertEqual(self.index.blocks_with('fish'), [])
+
+    def test_replace_block(self):
+        self.index.set_block(3, {'fsih'})
+        self.index.set_block(7, set())
+        self.assertEqual(self.index.blocks_with('teh'), [0])
+        self.assertEqual(self.index.blocks_with('wrod'), [])
+        self.assertEqual(self.index.blocks_with('fsih'), [3])
+        self.assertNotIn('wrod', self.index.blocks)
+
+    def test_added_blocks(self):
+        self.index.shift_blocks(3, 2)
+        self.assertEqual(self.index.blocks_with('teh'), [0, 3])
+        self.assertEqual(self.index.blocks_with('wrod'), [3, 9])
+
+    def test_removed_blocks(self):
+        self.index.shift_blocks(0, -3)
+        self.assertEqual(self.index.blocks_with('teh'), [0])
+        self.assertEqual(self.index.blocks_with('wrod'), [4])
@@ -0,0 +1,78 @@
+import json
+import os
+import tempfile
+import unittest
+from startuptrace import StartupTrace
+
+
+class StartupTraceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trace = StartupTrace()
+
+    def test_disabled(self):
+        with self.trace.phase('a'):
+            pass
+        self.assertEqual(self.trace.phases, [])
+        self.assertIsNone(self.trace.finish())
+
+    def test_nested_phases(self):
+        self.trace.start()
+        with self.trace.phase('plugins'):
+            with self.trace.phase('foo'):
+                pass
+        self.trace.finish()
+        self.assertEqual([p[0] for p in self.trace.phases],
+                         ['plugins > foo', 'plugins'])
+
+    def test_summary_sorted(self):
+        self.trace.phases = [('fast', 0.001, 0), ('slow', 0.5, 2048),
+                             ('medium', 0.1, 0)]
+        self.trace.total_time = 0.6
+        self.assertEqual(self.trace.summary(count=2),
+                         'Startup took 600 ms. Slowest: slow 500 ms, medium 100 ms')
+
+    def test_json(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.trace.start(path)
+            with self.trace.phase('a'):
+                pass
+            self.trace.finish()
+            with open(path) as f:
+                data = json.load(f)
+        finally:
+            os.remove(path)
+        self.assertEqual([p['name'] for p in data['phases']], ['a'])
+
+    def test_json_overwrites_old_trace(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for name in ['a', 'b']:
+                self.trace.start(path)
+                with self.trace.phase(name):
+                    pass
+                self.trace.finish()
+            with open(path) as f:
+                data = json.load(f)
+        finally:
+            os.remove(path)
+        self.assertEqual([p['name'] for p in data['phases']], ['b'])
+
+    def test_json_doesnt_overwrite_other_files(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('My novel')
+        try:
+            self.trace.start(path)
+            self.assertIn('could not write', self.trace.finish())
+            with open(path) as f:
+                self.assertEqual(f.read(), 'My novel')
+        finally:
+            os.remove(path)
+
+    def test_json_path_in_summary(self):
+        self.trace.start('/nonexistent/dir/trace.json')
+        self.assertIn('could not write', self.trace.finish())
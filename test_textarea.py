@@ -0,0 +1,62 @@
+import unittest
+import codecs
+from textarea import decode_text, format_size, get_chunk_end, normalize_newlines
+
+
+class DecodeTextTest(unittest.TestCase):
+
+    def test_utf8(self):
+        self.assertEqual(decode_text('hëj'.encode('utf-8')), ('hëj', 'utf-8'))
+
+    def test_latin1_fallback(self):
+        self.assertEqual(decode_text('hëj'.encode('latin1')), ('hëj', 'latin1'))
+
+    def test_utf8_bom(self):
+        data = codecs.BOM_UTF8 + 'hëj'.encode('utf-8')
+        self.assertEqual(decode_text(data), ('hëj', 'utf-8-sig'))
+
+    def test_utf16_bom(self):
+        self.assertEqual(decode_text('hëj'.encode('utf-16')), ('hëj', 'utf-16'))
+
+    def test_utf32_bom(self):
+        self.assertEqual(decode_text('hëj'.encode('utf-32')), ('hëj', 'utf-32'))
+
+    def test_newlines(self):
+        self.assertEqual(decode_text(b'a\r\nb\rc\n')[0], 'a\nb\nc\n')
+
+    def test_not_normalized(self):
+        self.assertEqual(decode_text(b'a\r\nb', normalize=False)[0], 'a\r\nb')
+
+    def test_no_working_encoding(self):
+        self.assertIsNone(decode_text(b'\xff', encodings=('utf-8',)))
+
+
+class NormalizeNewlinesTest(unittest.TestCase):
+
+    def test_mixed(self):
+        self.assertEqual(normalize_newlines('a\r\nb\rc\n\r\r\n'), 'a\nb\nc\n\n\n')
+
+    def test_nothing_to_do(self):
+        text = 'a\nb'
+        self.assertIs(normalize_newlines(text), text)
+
+
+class FormatSizeTest(unittest.TestCase):
+
+    def test_sizes(self):
+        self.assertEqual(format_size(12), '12 B')
+        self.assertEqual(format_size(2048), '2.0 KB')
+        self.assertEqual(format_size(5.5*1024**2), '5.5 MB')
+        self.assertEqual(format_size(3*1024**4), '3072.0 GB')
+
+
+class GetChunkEndTest(unittest.TestCase):
+
+    def test_end_of_line(self):
+        self.assertEqual(get_chunk_end('abc\ndef\nghi', 0, 2), 4)
+
+    def test_exactly_at_newline(self):
+        self.assertEqual(get_chunk_end('abc\ndef\nghi', 4, 3), 8)
+
+    def test_last_chunk(self):
+        self.assertEqual(get_chunk_end('abc\ndef\nghi', 8, 2), 11)
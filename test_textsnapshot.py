@@ -0,0 +1,63 @@
+import unittest
+from textsnapshot import TextSnapshot
+
+
+class FakeSignal():
+    def __init__(self):
+        self.slots = []
+    def connect(self, slot):
+        self.slots.append(slot)
+    def emit(self, *args):
+        for slot in self.slots:
+            slot(*args)
+
+class FakeDocument():
+    def __init__(self, text):
+        self.contentsChange = FakeSignal()
+        self.set_text(text)
+        self.rev = 0
+    def set_text(self, text):
+        self.plain_text = text
+        self.rev = getattr(self, 'rev', 0) + 1
+        self.contentsChange.emit(0, 0, len(text))
+    def revision(self):
+        return self.rev
+    def toPlainText(self):
+        return self.plain_text
+
+
+class TextSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.document = FakeDocument('abc\ndef')
+        self.snapshot = TextSnapshot(self.document)
+
+    def test_cached(self):
+        self.assertEqual(self.snapshot.text(), 'abc\ndef')
+        self.assertEqual(self.snapshot.text(), 'abc\ndef')
+        self.assertEqual((self.snapshot.copies, self.snapshot.hits), (1, 1))
+
+    def test_lines(self):
+        self.assertEqual(self.snapshot.lines(), ['abc', 'def'])
+        self.assertEqual(self.snapshot.copies, 1)
+
+    def test_dropped_on_edit(self):
+        self.snapshot.text()
+        self.document.set_text('ghi')
+        self.assertEqual(self.snapshot.text(), 'ghi')
+        self.assertEqual(self.snapshot.lines(), ['ghi'])
+        self.assertEqual(self.snapshot.copies, 2)
+
+    def test_format_change(self):
+        self.snapshot.text()
+        # Highlighting emits contentsChange without a new revision
+        self.document.contentsChange.emit(0, 3, 3)
+        self.snapshot.text()
+        self.assertEqual((self.snapshot.copies, self.snapshot.hits), (1, 1))
+
+    def test_new_revision(self):
+        self.snapshot.text()
+        # Eg. an edit whose signal hasn't reached the snapshot yet
+        self.document.plain_text = 'ghi'
+        self.document.rev += 1
+        self.assertEqual(self.snapshot.text(), 'ghi')
@@ -15,10 +15,14 @@
 # You should have received a copy of the GNU General Public License
 # along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
 
+import codecs
+import hashlib
 import os.path
 import re
 import subprocess
 import sys
+import threading
+import time
 try:
     import enchant
 except ImportError:
@@ -29,10 +33,14 @@ else:
 from PyQt4 import QtCore, QtGui
 from PyQt4.QtCore import pyqtSignal
 
-from libsyntyche.common import write_file
 from libsyntyche.filehandling import FileHandler
+from blockindex import BlockIndex
 from linewidget import LineTextWidget
-from common import Configable, SettingsError
+from searchindex import MatchIndex, compile_search_pattern, from_qt_position,\
+                        get_astral_indexes, to_qt_position, unescape_slashes
+from spellcheck import Highlighter, SpellCache
+from textsnapshot import TextSnapshot
+from common import Configable, SettingsError, write_file_atomically
 
 
 class TextArea(LineTextWidget, FileHandler, Configable):
@@ -47,15 +55,18 @@ class TextArea(LineTextWidget, FileHandler, Configable):
     file_created = pyqtSignal()
     file_opened = pyqtSignal()
     file_saved = pyqtSignal()
+    save_finished = pyqtSignal(str, str, int)
 
     def __init__(self, parent, settingsmanager):
         super().__init__(parent)
         self.init_settings_functions(settingsmanager)
         # This function is actually in linewidget.py
-        self.register_setting('Line Numbers', self.set_number_bar_visibility)
-        self.register_setting('Vertical Scrollbar', self.set_vscrollbar_visibility)
+        self.register_setting('Line Numbers', self.set_number_bar_visibility, False)
+        self.register_setting('Vertical Scrollbar', self.set_vscrollbar_visibility, 'on')
         self.register_setting('max Page Width', self.set_maximum_width)
-        self.register_setting('Show WordCount in titlebar', self.set_show_wordcount)
+        self.register_setting('Show WordCount in titlebar', self.set_show_wordcount, False)
+        self.register_setting('spellcheck cache size', self.set_spellcache_size,
+                              SpellCache.default_size)
 
         self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
         self.setTabStopWidth(30)
@@ -67,9 +78,38 @@ class TextArea(LineTextWidget, FileHandler, Configable):
             self.cursor_position_changed.emit(blocknumber)
         self.cursorPositionChanged.connect(new_cursor_position)
 
+        # This has to be created before anything else that reads the text
+        # when the document changes, so the old text is dropped first
+        self.snapshot = TextSnapshot(self.document())
+        self.block_index = BlockIndex(self.document(), self.snapshot)
+        self.block_index.wordcount_changed.connect(self.live_wordcount_changed)
+
         self.blocks = 0
         self.search_buffer = None
-        self.highlighter = None
+        self.search_regex = False
+        self.search_text = None
+        self.match_index = None
+        self.match_index_timer = QtCore.QTimer(self)
+        self.match_index_timer.setSingleShot(True)
+        self.match_index_timer.setInterval(300)
+        self.match_index_timer.timeout.connect(self.get_match_index)
+        self.match_index_timer.timeout.connect(self.update_match_highlights)
+        self.revision = self.document().revision()
+        self.document().contentsChange.connect(self.contents_changed)
+        self.verticalScrollBar().valueChanged.connect(self.update_match_highlights)
+        self.spellcache = SpellCache()
+        # Attached while the document is still empty, since attaching a
+        # highlighter makes Qt rehighlight the whole document
+        self.highlighter = Highlighter(self, self.spellcache,
+                                       self.visible_block_range)
+        self.highlighter.setDocument(self.document())
+        self.verticalScrollBar().valueChanged.connect(
+                    self.highlighter.check_visible_blocks)
+        self.loader = None
+        self.save_thread = None
+        self.saves_in_progress = 0
+        self.last_saved = None
+        self.save_finished.connect(self.background_save_finished)
         self.file_path = ''
         self.show_wordcount = False
 
@@ -107,16 +147,35 @@ class TextArea(LineTextWidget, FileHandler, Configable):
     def set_show_wordcount(self, value):
         self.show_wordcount = value
         self.wordcount_changed.emit(self.get_wordcount())
+
+    def set_spellcache_size(self, value):
+        if value < 0:
+            raise SettingsError('The spell check cache size can\'t be negative!')
+        self.spellcache.resize(value)
     # ===============================================================
 
     def get_wordcount(self):
-        return len(re.findall(r'\S+', self.document().toPlainText()))
+        return self.block_index.total_words
+
+    def live_wordcount_changed(self, wordcount):
+        if self.show_wordcount and self.loader is None:
+            self.wordcount_changed.emit(wordcount)
 
     def print_wordcount(self):
         self.print_('Words: {}'.format(self.get_wordcount()))
 
+    def toPlainText(self):
+        """
+        Return the document's text without copying it again if nothing
+        has changed since the last time.
+        """
+        return self.snapshot.text()
+
     def print_filename(self, arg):
         """ Wrapper callback for the f command. """
+        if arg == '#':
+            self.print_(self.snapshot.stats())
+            return
         try:
             result = get_file_info(arg, self.file_path, self.is_modified)
         except KeyError as e:
@@ -139,9 +198,16 @@ class TextArea(LineTextWidget, FileHandler, Configable):
         self.setFocus()
 
 
+    def visible_block_range(self):
+        """ Return the numbers of the first and last visible blocks. """
+        first = self.firstVisibleBlock().blockNumber()
+        bottom = QtCore.QPoint(0, self.viewport().height() - 1)
+        return first, self.cursorForPosition(bottom).blockNumber()
+
     def new_line(self, blocks):
         """ Generate auto-indentation if the option is enabled. """
-        if self.get_setting('Auto-Indent') and blocks > self.blocks:
+        if self.get_setting('Auto-Indent') and blocks > self.blocks \
+                    and self.loader is None:
             cursor = self.textCursor()
             blocknum = cursor.blockNumber()
             prevblock = self.document().findBlockByNumber(blocknum-1)
@@ -151,23 +217,6 @@ class TextArea(LineTextWidget, FileHandler, Configable):
 
     ## ==== Spellcheck ==================================================== ##
 
-    class Highlighter(QtGui.QSyntaxHighlighter):
-        def __init__(self, *args):
-            super().__init__(*args)
-            self.dict = None
-
-        def highlightBlock(self, text):
-            if not self.dict:
-                return
-
-            format = QtGui.QTextCharFormat()
-            format.setUnderlineColor(QtCore.Qt.red)
-            format.setUnderlineStyle(QtGui.QTextCharFormat.SpellCheckUnderline)
-
-            for word in re.finditer(r'(?i)[\w\']+', text):
-                if not self.dict.check(word.group().strip("'")):
-                    self.setFormat(word.start(), word.end() - word.start(), format)
-
     def spellcheck(self, arg):
         def get_word():
             cursor = self.textCursor()
@@ -177,11 +226,13 @@ class TextArea(LineTextWidget, FileHandler, Configable):
         if not enchant_present:
             self.error('PyEnchant spell check dependency not installed!')
             return
-        if self.highlighter is None:
-            self.highlighter = self.Highlighter(self)
+        if self.highlighter.dict is None:
             self.set_spellcheck_language(self.get_setting('default spellcheck language'))
         if arg == '?':
-            self.print_('&: toggle, &en_US: set language, &=: check word, &+: add word')
+            self.print_('&: toggle, &en_US: set language, &=: check word, '
+                        '&+: add word, &#: cache stats')
+        elif arg == '#':
+            self.print_(self.spellcache.stats())
         elif arg == '=':
             word = get_word()
             if re.match(r'[\w\']+$', word):
@@ -192,17 +243,20 @@ class TextArea(LineTextWidget, FileHandler, Configable):
             if re.match(r'[\w\']+$', word):
                 self.prompt('&+' + word)
         elif arg.startswith('+'):
+            if self.still_loading():
+                return
             self.highlighter.dict.add_to_pwl(arg[1:])
             lang = self.highlighter.dict.tag
-            self.highlighter.rehighlight()
+            self.spellcache.forget(lang, arg[1:].strip("'"))
+            self.highlighter.word_added(arg[1:].strip("'"))
             self.print_('Added to {} dictionary: {}'.format(lang, arg[1:]))
         elif not arg:
-            if self.highlighter.document() is None:
-                self.highlighter.setDocument(self.document())
+            if not self.highlighter.active:
+                self.highlighter.set_active(True)
                 lang = self.highlighter.dict.tag
                 self.print_('Spell check is now on ({})'.format(lang))
             else:
-                self.highlighter.setDocument(None)
+                self.highlighter.set_active(False)
                 self.print_('Spell check is now off')
         else:
             self.set_spellcheck_language(arg)
@@ -212,7 +266,7 @@ class TextArea(LineTextWidget, FileHandler, Configable):
             pwlpath = self.get_path('spellcheck-pwl')
             pwl = os.path.join(pwlpath, lang+'.pwl')
             self.highlighter.dict = enchant.DictWithPWL(lang, pwl=pwl)
-            self.highlighter.rehighlight()
+            self.highlighter.start_pass()
             self.print_('Language set to {}'.format(lang))
         else:
             self.error('Language {} does not exist!'.format(lang))
@@ -229,32 +283,42 @@ class TextArea(LineTextWidget, FileHandler, Configable):
                 self.search_flags |= QtGui.QTextDocument.FindCaseSensitively
             if 'w' in flagstr:
                 self.search_flags |= QtGui.QTextDocument.FindWholeWords
+            self.search_regex = 'r' in flagstr
 
+        if self.still_loading():
+            return
         search_rx = re.compile(r'([^/]|\\/)+$')
-        search_flags_rx = re.compile(r'([^/]|\\/)*?([^\\]/[biw]*)$')
+        search_flags_rx = re.compile(r'([^/]|\\/)*?([^\\]/[biwr]*)$')
         replace_rx = re.compile(r"""
             (?P<search>([^/]|\\/)*?[^\\])
             /
             (?P<replace>(([^/]|\\/)*[^\\])?)
             /
-            (?P<flags>[abiw]*)
+            (?P<flags>[abiwr]*)
             $
         """, re.VERBOSE)
 
         if search_rx.match(arg):
             self.search_buffer = search_rx.match(arg).group(0)
             self.search_flags = QtGui.QTextDocument.FindCaseSensitively
+            self.search_regex = False
+            self.new_search()
             self.search_next()
 
         elif search_flags_rx.match(arg):
             self.search_buffer, flags = search_flags_rx.match(arg).group(0).rsplit('/', 1)
             generate_flags(flags)
-            self.search_next()
+            if self.valid_search_regex():
+                self.new_search()
+                self.search_next()
 
         elif replace_rx.match(arg):
             match = replace_rx.match(arg)
             self.search_buffer = match.group('search')
             generate_flags(match.group('flags'))
+            if not self.valid_search_regex():
+                return
+            self.new_search()
             if 'a' in match.group('flags'):
                 self.replace_all(match.group('replace'))
             else:
@@ -266,70 +330,189 @@ class TextArea(LineTextWidget, FileHandler, Configable):
     def searching_backwards(self):
         return QtGui.QTextDocument.FindBackward & self.search_flags
 
+    def get_search_pattern(self):
+        return compile_search_pattern(self.search_buffer,
+                case_sensitive=bool(self.search_flags & QtGui.QTextDocument.FindCaseSensitively),
+                whole_words=bool(self.search_flags & QtGui.QTextDocument.FindWholeWords),
+                regex=self.search_regex)
+
+    def valid_search_regex(self):
+        try:
+            self.get_search_pattern()
+        except re.error as e:
+            self.error('Invalid regex: {}'.format(e))
+            self.search_buffer = None
+            self.clear_match_index()
+            return False
+        return True
+
+    def get_search_text(self):
+        """
+        Return the plain text and its astral indexes (see
+        get_astral_indexes), cached until the document is changed.
+        """
+        if self.search_text is None:
+            text = self.snapshot.text()
+            self.search_text = (text, get_astral_indexes(text))
+        return self.search_text
+
+    def contents_changed(self, position, chars_removed, chars_added):
+        # The spell check's rehighlighting emits contentsChange without
+        # changing any text, which mustn't invalidate the search
+        revision = self.document().revision()
+        if chars_removed == chars_added and revision == self.revision:
+            return
+        self.revision = revision
+        self.search_text = None
+        self.update_match_index(position, chars_removed, chars_added)
+
+    def new_search(self):
+        """ Set up the match index for a new search term. """
+        self.match_index = None
+        self.get_match_index()
+        self.update_match_highlights()
+
+    def clear_match_index(self):
+        """ Forget the matches and their highlights, eg. when opening a file. """
+        self.match_index_timer.stop()
+        self.match_index = None
+        self.search_text = None
+        self.setExtraSelections([])
+
+    def get_match_index(self):
+        """ Return the match index, creating or rebuilding it first if needed. """
+        if self.match_index is None and self.search_buffer is not None:
+            self.match_index = MatchIndex(self.document(), self.get_search_pattern(),
+                                          literal=not self.search_regex)
+        if self.match_index is not None and not self.match_index.valid:
+            self.match_index.build(*self.get_search_text())
+        return self.match_index
+
+    def update_match_index(self, position, chars_removed, chars_added):
+        if self.match_index is None:
+            return
+        self.match_index.contents_changed(position, chars_removed, chars_added)
+        if self.match_index.valid:
+            self.update_match_highlights()
+        else:
+            # Rebuilding the index requires the whole text, so wait until
+            # the user has stopped typing (or the file has been loaded)
+            self.setExtraSelections([])
+            if self.loader is None:
+                self.match_index_timer.start()
+
+    def update_match_highlights(self):
+        """ Highlight all matches that are visible right now. """
+        index = self.match_index
+        if index is None or not index.valid:
+            return
+        top = self.firstVisibleBlock().position()
+        bottom_point = QtCore.QPoint(self.viewport().width() - 1,
+                                     self.viewport().height() - 1)
+        bottom_block = self.cursorForPosition(bottom_point).block()
+        bottom = bottom_block.position() + bottom_block.length()
+        format = QtGui.QTextCharFormat()
+        color = self.palette().color(QtGui.QPalette.Highlight)
+        color.setAlpha(80)
+        format.setBackground(color)
+        selections = []
+        for n in index.matches_between(top, bottom):
+            selection = QtGui.QTextEdit.ExtraSelection()
+            selection.cursor = QtGui.QTextCursor(self.document())
+            selection.cursor.setPosition(index.starts[n])
+            selection.cursor.setPosition(index.ends[n], QtGui.QTextCursor.KeepAnchor)
+            selection.format = format
+            selections.append(selection)
+        self.setExtraSelections(selections)
+
+    def find_next_match(self):
+        """
+        Select the next match after the cursor (or the previous one if
+        searching backwards), wrapping around if needed.
+        Return the number of the match, or None if there are no matches.
+        """
+        index = self.get_match_index()
+        cursor = self.textCursor()
+        if self.searching_backwards():
+            n = index.previous_match(cursor.selectionStart())
+        else:
+            n = index.next_match(cursor.selectionEnd())
+        if n is None:
+            return None
+        cursor.setPosition(index.starts[n])
+        cursor.setPosition(index.ends[n], QtGui.QTextCursor.KeepAnchor)
+        self.setTextCursor(cursor)
+        return n
+
     def search_next(self):
         if self.search_buffer is None:
             self.error('No previous searches')
             return
-        temp_cursor = self.textCursor()
-        found = self.find(self.search_buffer, self.search_flags)
-        if not found:
-            if not self.textCursor().atStart() \
-                        or (self.searching_backwards() and not self.textCursor().atEnd()):
-                if self.searching_backwards():
-                    self.moveCursor(QtGui.QTextCursor.End)
-                else:
-                    self.moveCursor(QtGui.QTextCursor.Start)
-                found = self.find(self.search_buffer, self.search_flags)
-                if not found:
-                    self.setTextCursor(temp_cursor)
-                    self.error('Text not found')
-            else:
-                self.setTextCursor(temp_cursor)
-                self.error('Text not found')
+        n = self.find_next_match()
+        if n is None:
+            self.error('Text not found')
+        else:
+            self.print_('Match {} of {}'.format(n + 1, len(self.match_index)))
 
 
     def replace_next(self, replace_buffer):
-        temp_cursor = self.textCursor()
-        found = self.find(self.search_buffer, self.search_flags)
-        if not found:
-            if not self.textCursor().atStart() \
-                        or (self.searching_backwards() and not self.textCursor().atEnd()):
-                if self.searching_backwards():
-                    self.moveCursor(QtGui.QTextCursor.End)
-                else:
-                    self.moveCursor(QtGui.QTextCursor.Start)
-                found = self.find(self.search_buffer, self.search_flags)
-                if not found:
-                    self.setTextCursor(temp_cursor)
-        if found:
-            t = self.textCursor()
-            t.insertText(replace_buffer)
-            l = len(replace_buffer)
-            t.setPosition(t.position() - l)
-            t.setPosition(t.position() + l, QtGui.QTextCursor.KeepAnchor)
-            self.setTextCursor(t)
-            self.print_('Replaced on line {}, pos {}'
-                             ''.format(t.blockNumber(), t.positionInBlock()))
-        else:
+        n = self.find_next_match()
+        if n is None:
             self.error('Text not found')
+            return
+        if self.search_regex:
+            text, astrals = self.get_search_text()
+            start = from_qt_position(self.match_index.starts[n], astrals)
+            match = self.get_search_pattern().match(text, start)
+            try:
+                replace_buffer = match.expand(unescape_slashes(replace_buffer))
+            except re.error as e:
+                self.error('Invalid replacement: {}'.format(e))
+                return
+        t = self.textCursor()
+        t.insertText(replace_buffer)
+        l = len(replace_buffer)
+        t.setPosition(t.position() - l)
+        t.setPosition(t.position() + l, QtGui.QTextCursor.KeepAnchor)
+        self.setTextCursor(t)
+        self.print_('Replaced on line {}, pos {}'
+                         ''.format(t.blockNumber(), t.positionInBlock()))
 
 
     def replace_all(self, replace_buffer):
-        temp_cursor = self.textCursor()
-        times = 0
-        self.moveCursor(QtGui.QTextCursor.Start)
-        while True:
-            found = self.find(self.search_buffer, self.search_flags)
-            if found:
-                self.textCursor().insertText(replace_buffer)
-                times += 1
-            else:
-                break
-        if times:
-            self.print_('{0} instance{1} replaced'.format(times, 's'*(times>0)))
-        else:
+        """
+        Replace all matches in one go.
+
+        The matches are found with a regex over the plain text and replaced
+        from the end and back (so the positions stay valid) inside one edit
+        block, which means one undo step and one relayout.
+        """
+        start_time = time.perf_counter()
+        text, astrals = self.get_search_text()
+        matches = list(self.get_search_pattern().finditer(text))
+        if not matches:
             self.error('Text not found')
-        self.setTextCursor(temp_cursor)
+            return
+        if self.search_regex:
+            template = unescape_slashes(replace_buffer)
+            try:
+                replacements = [m.expand(template) for m in matches]
+            except re.error as e:
+                self.error('Invalid replacement: {}'.format(e))
+                return
+        else:
+            replacements = [replace_buffer] * len(matches)
+        cursor = QtGui.QTextCursor(self.document())
+        cursor.beginEditBlock()
+        for match, replacement in zip(reversed(matches), reversed(replacements)):
+            cursor.setPosition(to_qt_position(match.start(), astrals))
+            cursor.setPosition(to_qt_position(match.end(), astrals),
+                               QtGui.QTextCursor.KeepAnchor)
+            cursor.insertText(replacement)
+        cursor.endEditBlock()
+        times = len(matches)
+        self.print_('{0} instance{1} replaced in {2:.2f} s'.format(
+                    times, 's'*(times != 1), time.perf_counter() - start_time))
 
 
     ## ==== File ops help functions ======================================= ##
@@ -356,6 +539,9 @@ class TextArea(LineTextWidget, FileHandler, Configable):
         return self.get_setting('open in New Window') and (self.document().isModified() or self.file_path)
 
     def post_new(self):
+        self.stop_loading()
+        self.last_saved = None
+        self.clear_match_index()
         self.document().clear()
         self.document().setModified(False)
         self.blocks = 1
@@ -366,44 +552,258 @@ class TextArea(LineTextWidget, FileHandler, Configable):
         """
         Main open file function
         """
-        encodings = ('utf-8', 'latin1')
-        for e in encodings:
-            try:
-                with open(filename, encoding=e) as f:
-                    lines = f.readlines()
-            except UnicodeDecodeError:
-                continue
-            else:
-                self.document().setPlainText(''.join(lines))
-                self.document().setModified(False)
-                self.blocks = self.blockCount()
-                self.set_filename(filename)
-                if self.show_wordcount:
-                    self.wordcount_changed.emit(self.get_wordcount())
-                self.moveCursor(QtGui.QTextCursor.Start)
-                self.file_opened.emit()
-                return True
-        return False
+        start_time = time.perf_counter()
+        with open(filename, 'rb') as f:
+            data = f.read()
+        size = len(data)
+        # Big files get their newlines normalized a chunk at a time
+        result = decode_text(data, normalize=False)
+        del data
+        if result is None:
+            return False
+        text, encoding = result
+        del result
+        self.stop_loading()
+        # The file may not look like it did the last time it was saved
+        self.last_saved = None
+        self.clear_match_index()
+        def finish():
+            self.finish_open(filename, size, encoding, start_time)
+        threshold = self.get_setting('progressive loading threshold')
+        if threshold and size > threshold * 1024**2:
+            # Big files are loaded bit by bit to not freeze the window
+            self.setReadOnly(True)
+            self.loader = ProgressiveLoader(self.document(), text)
+            del text
+            self.loader.progress.connect(lambda percent:
+                    self.print_('Loading {}: {}%'.format(filename, percent)))
+            self.loader.finished.connect(finish)
+            self.loader.start()
+            self.moveCursor(QtGui.QTextCursor.Start)
+        else:
+            self.document().setPlainText(normalize_newlines(text))
+            del text
+            finish()
+        return True
+
+    def finish_open(self, filename, size, encoding, start_time):
+        self.stop_loading()
+        self.document().setModified(False)
+        self.blocks = self.blockCount()
+        self.set_filename(filename)
+        if self.show_wordcount:
+            self.wordcount_changed.emit(self.get_wordcount())
+        self.moveCursor(QtGui.QTextCursor.Start)
+        self.file_opened.emit()
+        elapsed = time.perf_counter() - start_time
+        self.print_('Loaded {} ({}) in {:.2f} s, {}/s'.format(
+                    format_size(size), encoding, elapsed,
+                    format_size(size / max(elapsed, 0.000001))))
+
+    def stop_loading(self):
+        """ Abort the progressive loading of a file, if there is one. """
+        if self.loader is not None:
+            self.loader.stop()
+            self.loader = None
+            self.setReadOnly(False)
+
+    def request_save_file(self, *args):
+        # Saving half a file would be a bad idea
+        if self.still_loading():
+            return
+        super().request_save_file(*args)
+
+    def still_loading(self):
+        """
+        Print an error and return True if the file is still being loaded.
+
+        Read-only mode doesn't stop edits made with text cursors, so
+        anything that changes the document has to check this first.
+        """
+        if self.loader is None:
+            return False
+        self.error('The file is still being loaded, wait a moment!')
+        return True
 
     def write_file(self, filename):
-        write_file(filename, self.document().toPlainText())
+        """
+        Save the text in a background thread.
+
+        Only the snapshot of the text is made here since the document can't
+        be touched outside the gui thread. post_save is run when the
+        thread is done.
+        """
+        if filename == self.file_path and not self.document().isModified():
+            return
+        text = self.snapshot.text()
+        revision = self.document().revision()
+        self.saves_in_progress += 1
+        thread = threading.Thread(target=self.write_in_background,
+                                  args=(filename, text, revision, self.save_thread))
+        self.save_thread = thread
+        thread.start()
+
+    def write_in_background(self, filename, text, revision, previous_thread):
+        """ Write the text to the file, unless it's the same as last time. """
+        # Keep the saves in order
+        if previous_thread is not None:
+            previous_thread.join()
+        # Whatever happens, save_finished has to be emitted, or the
+        # saves in progress are never counted down
+        error = 'the save was interrupted'
+        try:
+            data = text.encode('utf-8')
+            del text
+            key = (filename, hashlib.sha1(data).digest())
+            if key != self.last_saved:
+                write_file_atomically(filename, data)
+                self.last_saved = key
+            error = ''
+        except OSError as e:
+            error = str(e)
+        except Exception as e:
+            error = 'unexpected error: {}: {}'.format(type(e).__name__, e)
+        finally:
+            self.save_finished.emit(filename, error, revision)
+
+    def background_save_finished(self, filename, error, revision):
+        self.saves_in_progress -= 1
+        if error:
+            self.error('File could not be saved: {}'.format(error))
+        else:
+            self.finish_save(filename, revision)
 
     def post_save(self, filename):
+        # Saves in the background call finish_save themselves when done
+        if not self.saves_in_progress:
+            self.finish_save(filename, self.document().revision())
+
+    def finish_save(self, filename, revision):
         if self.show_wordcount:
             self.wordcount_changed.emit(self.get_wordcount())
         self.set_filename(filename)
-        self.document().setModified(False)
+        # Don't mark changes made during the save as saved
+        if revision == self.document().revision():
+            self.document().setModified(False)
         self.file_saved.emit()
 
 
+class ProgressiveLoader(QtCore.QObject):
+    """
+    Put a big text into a document a chunk at a time from the event loop.
+
+    The first chunk is small to get something on the screen right away.
+    Undo is turned off while loading so the chunks don't end up in the
+    undo stack.
+    """
+    progress = pyqtSignal(int)
+    finished = pyqtSignal()
+
+    def __init__(self, document, text, chunk_size=1024**2, first_chunk_size=32*1024):
+        super().__init__()
+        self.document = document
+        self.text = text
+        self.position = 0
+        self.chunk_size = chunk_size
+        self.first_chunk_size = first_chunk_size
+        self.percent = 0
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.load_next_chunk)
+
+    def start(self):
+        self.document.setUndoRedoEnabled(False)
+        self.document.setPlainText(self.next_chunk(self.first_chunk_size))
+        self.timer.start(0)
+
+    def stop(self):
+        self.timer.stop()
+        self.text = ''
+        self.document.setUndoRedoEnabled(True)
+
+    def next_chunk(self, size):
+        end = get_chunk_end(self.text, self.position, size)
+        # The chunks end after a \n, so no \r\n is split in two
+        chunk = normalize_newlines(self.text[self.position:end])
+        self.position = end
+        return chunk
+
+    def load_next_chunk(self):
+        cursor = QtGui.QTextCursor(self.document)
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.insertText(self.next_chunk(self.chunk_size))
+        if self.position < len(self.text):
+            percent = 100 * self.position // len(self.text)
+            if percent // 10 > self.percent // 10:
+                self.progress.emit(percent)
+            self.percent = percent
+            self.timer.start(0)
+        else:
+            self.stop()
+            self.finished.emit()
+
+
 # ==== Loose functions ==========================================
 
+def get_chunk_end(text, start, size):
+    """
+    Return the position where a chunk of (at least) size characters that
+    begins at start should end, to not split any lines.
+    """
+    end = text.find('\n', start + size)
+    return len(text) if end == -1 else end + 1
+
+def decode_text(data, encodings=('utf-8', 'latin1'), normalize=True):
+    """
+    Return a tuple with the decoded text and the name of the encoding used,
+    or None if none of the encodings work.
+
+    A byte order mark overrides the encodings. Unless normalize is False,
+    newlines are normalized (see normalize_newlines).
+    """
+    boms = ((codecs.BOM_UTF8, 'utf-8-sig'),
+            (codecs.BOM_UTF32_LE, 'utf-32'),
+            (codecs.BOM_UTF32_BE, 'utf-32'),
+            (codecs.BOM_UTF16_LE, 'utf-16'),
+            (codecs.BOM_UTF16_BE, 'utf-16'))
+    for bom, encoding in boms:
+        if data.startswith(bom):
+            encodings = (encoding,) + tuple(encodings)
+            break
+    for encoding in encodings:
+        try:
+            text = data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        if normalize:
+            text = normalize_newlines(text)
+        return text, encoding
+    return None
+
+def normalize_newlines(text):
+    """
+    Turn all newlines into \\n, the same way as when reading files in
+    text mode. Done in one pass to not make more copies of big texts.
+    """
+    if '\r' not in text:
+        return text
+    return re.sub('\r\n?', '\n', text)
+
+def format_size(size):
+    """ Return a human-readable version of a size in bytes. """
+    if size < 1024:
+        return '{} B'.format(int(size))
+    for unit in ('KB', 'MB', 'GB'):
+        size /= 1024
+        if size < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(size, unit)
+
 def get_file_info(arg, file_path, is_modified):
     """ Parse the f command and return the requested information """
     if arg not in ('n','d','m','?',''):
         raise KeyError('Invalid argument')
     if arg == '?':
-        return 'f=full path, fn=name, fd=directory, fm=modified'
+        return 'f=full path, fn=name, fd=directory, fm=modified, f#=text snapshot stats'
     if file_path:
         if arg == 'n':
             return os.path.basename(file_path)
@@ -0,0 +1,66 @@
+# Copyright nycz 2011-2013
+
+# This file is part of Kalpana.
+
+# Kalpana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Kalpana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Kalpana. If not, see <http://www.gnu.org/licenses/>.
+
+
+class TextSnapshot():
+    """
+    The plain text of a document, copied at most once per revision.
+
+    Everything that needs the whole text should get it from here instead
+    of calling toPlainText, so several readers between two edits share
+    the same copy. A new copy is only made when the document's revision
+    has changed, and the old copy is dropped right away when it does.
+    contentsChange signals that only change formats (eg. from the spell
+    check) keep the copy.
+    """
+    def __init__(self, document):
+        self.document = document
+        self.revision = None
+        self.cached_text = None
+        self.copies = 0
+        self.hits = 0
+        document.contentsChange.connect(self.drop)
+
+    def drop(self, *args):
+        # Don't keep an outdated copy of a big text around, but
+        # formatting changes don't change the revision or the text
+        if self.document.revision() != self.revision:
+            self.cached_text = None
+
+    def text(self):
+        """ Return the plain text of the document. """
+        revision = self.document.revision()
+        if self.cached_text is None or revision != self.revision:
+            self.cached_text = self.document.toPlainText()
+            self.revision = revision
+            self.copies += 1
+        else:
+            self.hits += 1
+        return self.cached_text
+
+    def lines(self):
+        """
+        Return the text split into lines (one for every block).
+
+        The lines aren't cached, since keeping them around next to the
+        text would double the memory used for big files.
+        """
+        return self.text().split('\n')
+
+    def stats(self):
+        return 'Text snapshots: {} copies made, {} copies saved'\
+               ''.format(self.copies, self.hits)